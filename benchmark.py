@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import multiprocessing
+import sys
+
+from model import *
+from parallel import init_process, launch, share_cores
+from preprocess import PAD_token, SOS_token, EOS_token, Corpus, WordDict, build_word_dict
+from seq2seq import transformer
+from seq2seq.beam import BeamSearch
+from utils import now
+
+Config.use_cuda = False
+
+
+def loop_attention(attn, hidden, encoder_outputs):
+    # Per-position scoring as Attn.forward did it before: one score call per encoder output
+    batch_size, encoder_outputs_len, _ = encoder_outputs.size()
+    attn_energies = Variable(torch.zeros((batch_size, encoder_outputs_len)))
+    for i in range(encoder_outputs_len):
+        attn_energies[:, i] = attn.score(hidden, attn.keys(encoder_outputs[:, i:i + 1])).squeeze(1)
+    return F.softmax(attn_energies, dim=1)
+
+
+def bench_attention(method=attn_model, batch_size=100, seq_len=Config.max_seq_length, n_steps=20):
+    attn = Attn(method, hidden_size)
+    hidden = Variable(torch.randn(batch_size, hidden_size), volatile=True)
+    encoder_outputs = Variable(torch.randn(batch_size, seq_len, hidden_size), volatile=True)
+    mask = encoder_mask([seq_len] * batch_size, seq_len)
+    keys = attn.keys(encoder_outputs)
+
+    results = []
+    for name, fn in [('loop', lambda: loop_attention(attn, hidden, encoder_outputs)),
+                     ('batched', lambda: attn(hidden, attn.keys(encoder_outputs), mask)),
+                     ('precomputed keys', lambda: attn(hidden, keys, mask))]:
+        fn()  # warm up
+        start = now()
+        for _ in range(n_steps):
+            fn()
+        steps_per_sec = n_steps / (now() - start)
+        results.append(steps_per_sec)
+        print('attn[{}] {}: {:.1f} steps/sec (B={}, S={}, H={})'.format(method, name, steps_per_sec,
+                                                                       batch_size, seq_len, hidden_size))
+    print('attn[{}] speedup: batched {:.1f}x, precomputed keys {:.1f}x'.format(method, results[1] / results[0],
+                                                                               results[2] / results[0]))
+    return results
+
+
+def bench_beam(beam_sizes=(1, 2, 4, 8), n_classes=5000, batch_size=20, seq_len=30, max_length=30):
+    # Untrained weights rarely emit EOS, so every width decodes the full max_length: the cost of the width itself
+    encoder, decoder = get_model(n_classes, load=False)
+    input_variable = Variable(torch.LongTensor(batch_size, seq_len).random_(3, n_classes), volatile=True)
+    len_inputs = [seq_len] * batch_size
+    encoder_outputs, encoder_hidden = encoder(input_variable, len_inputs, encoder.init_hidden(batch_size))
+    mask = encoder_mask(len_inputs, seq_len)
+
+    results = []
+    for beam_size in beam_sizes:
+        searcher = BeamSearch(decoder, beam_size, max_length, SOS_token, EOS_token, PAD_token)
+        searcher.decode(encoder_outputs, encoder_hidden, mask)
+        results.append(searcher.tokens_per_sec())
+        print('beam[{}]: {:.1f} tokens/sec (B={}, V={})'.format(beam_size, results[-1], batch_size, n_classes))
+    return results
+
+
+def bench_encode(path=Config.eval_data_path, batch_size=100, n_batches=20):
+    # Per-sentence encoding with pad_indexes against the batch WordDict calls on the same sentences
+    word_dict = WordDict()
+    sentences = [line.strip().split('\t')[0] for line in open(path)][:batch_size * n_batches]
+    for sentence in sentences:
+        word_dict.add_indexes(sentence)
+    batches = [sentences[i:i + batch_size] for i in range(0, len(sentences), batch_size)]
+    max_length = Config.max_seq_length
+
+    def loop():
+        for batch in batches:
+            encoded = [word_dict.sentence_to_indexes(sentence, max_length) for sentence in batch]
+            [word_dict.indexes_to_sentence(indexes) for indexes, _ in encoded]
+
+    def batched():
+        for batch in batches:
+            word_dict.indexes_to_sentences(word_dict.sentences_to_indexes(batch, max_length)[0])
+
+    results = []
+    for name, fn in [('loop', loop), ('batched', batched)]:
+        fn()  # warm up
+        start = now()
+        fn()
+        results.append(len(sentences) / (now() - start))
+        print('encode {}: {:.1f} sentences/sec (B={}, S={})'.format(name, results[-1], batch_size, max_length))
+    print('encode speedup: batched {:.1f}x'.format(results[1] / results[0]))
+    return results
+
+
+def bench_decoder(batch_size=32, seq_len=30, n_classes=5000, n_steps=5):
+    # Teacher-forced decoder forward and backward over a whole target: AttnDecoderRNN one step at a time, and
+    # LuongDecoderRNN both one step at a time and in one sequence_features call
+    inputs = Variable(torch.LongTensor(batch_size, seq_len).random_(3, n_classes))
+    encoder_outputs = Variable(torch.randn(batch_size, seq_len, hidden_size))
+    encoder_hidden = Variable(torch.randn(n_layers, batch_size, hidden_size))
+    mask = encoder_mask([seq_len] * batch_size, seq_len)
+    context = Variable(torch.zeros(batch_size, hidden_size))
+
+    def loop(decoder):
+        hidden, last_context, features = encoder_hidden, context, []
+        for t in range(seq_len):
+            feature, last_context, hidden, _ = decoder.features(inputs[:, t:t + 1], last_context, hidden,
+                                                                encoder_outputs, None, mask)
+            features.append(feature.unsqueeze(1))
+        decoder.out(torch.cat(features, 1)).sum().backward()
+
+    def sequence(decoder):
+        features, _, _ = decoder.sequence_features(inputs, encoder_hidden, encoder_outputs, None, mask)
+        decoder.out(features).sum().backward()
+
+    results = []
+    for name, decoder_class, fn in [('input feeding, per step', AttnDecoderRNN, loop),
+                                    ('luong, per step', LuongDecoderRNN, loop),
+                                    ('luong, whole target', LuongDecoderRNN, sequence)]:
+        decoder = decoder_class(attn_model, hidden_size, n_classes, n_layers, dropout_p=dropout_p)
+        fn(decoder)  # warm up
+        start = now()
+        for _ in range(n_steps):
+            fn(decoder)
+        results.append(n_steps * batch_size * seq_len / (now() - start))
+        print('decoder[{}]: {:.1f} tokens/sec (B={}, T={}, V={})'.format(name, results[-1], batch_size, seq_len,
+                                                                        n_classes))
+    print('decoder speedup: luong whole target {:.1f}x over input feeding'.format(results[2] / results[0]))
+    return results
+
+
+def parallel_worker(rank, world_size, n_steps, batch_size, seq_len, n_classes, results):
+    import train
+    if world_size > 1:
+        init_process(rank, world_size)
+    torch.manual_seed(rank)
+    encoder, decoder = get_model(n_classes, load=False)
+    encoder_optimizer, decoder_optimizer = optim.Adam(encoder.parameters()), optim.Adam(decoder.parameters())
+    inputs = Variable(torch.LongTensor(batch_size, seq_len).random_(4, n_classes))
+    targets = Variable(torch.LongTensor(batch_size, seq_len).random_(4, n_classes))
+    lengths = [seq_len] * batch_size
+    train.teacher_forcing_ratio = 1.  # the same work in every step
+
+    def step():
+        train.train(inputs, lengths, targets, lengths, encoder, decoder, encoder_optimizer, decoder_optimizer, None)
+
+    step()  # warm up
+    start = now()
+    for _ in range(n_steps):
+        step()
+    if rank == 0:
+        results.put(n_steps / (now() - start))
+
+
+def bench_parallel(world_sizes=(1, 2, 4), n_steps=10, batch_size=32, seq_len=20, n_classes=5000):
+    # Data-parallel train.train steps on random batches, every process with its own batch of batch_size. Scaling
+    # efficiency is the throughput of N processes over N times that of one process.
+    results = multiprocessing.Queue()
+    tokens_per_sec = []
+    for world_size in world_sizes:
+        launch(parallel_worker, world_size, n_steps, batch_size, seq_len, n_classes, results)
+        tokens_per_sec.append(world_size * batch_size * 2 * seq_len * results.get())
+        print('parallel[{}]: {:.1f} tokens/sec, scaling efficiency {:.0f}% (B={}, S={}, V={}, {} cores)'.format(
+            world_size, tokens_per_sec[-1], 100. * tokens_per_sec[-1] / (world_size * tokens_per_sec[0]), batch_size,
+            seq_len, n_classes, multiprocessing.cpu_count()))
+    return tokens_per_sec
+
+
+def hogwild_worker(rank, world_size, encoder, decoder, corpus, n_steps, batch_size, results):
+    import train
+    share_cores(world_size)
+    corpus.split(rank, world_size)
+    encoder_optimizer, decoder_optimizer = optim.Adam(encoder.parameters()), optim.Adam(decoder.parameters())
+    losses = []
+    for _ in range(n_steps):
+        inputs, targets, len_inputs, len_targets = corpus.next_batch(batch_size)
+        loss = train.train(Variable(torch.from_numpy(inputs)), len_inputs, Variable(torch.from_numpy(targets)),
+                           len_targets, encoder, decoder, encoder_optimizer, decoder_optimizer, None)
+        losses.append((now(), loss, sum(len_inputs) + sum(len_targets)))
+    results.put(losses)
+
+
+def bench_hogwild(world_sizes=(1, 2, 4), n_updates=200, batch_size=32, hidden=128, path=Config.eval_data_path,
+                  n_segments=5):
+    # The same number of updates on the pairs of path from one process and from Hogwild processes sharing the
+    # weights, each run starting from the same initial weights. The loss curve is the mean training loss over each
+    # n_segments-th of the updates, with the wall-clock time at which that part ended.
+    word_dict = build_word_dict([path])
+    corpus = Corpus(word_dict, Config.max_seq_length, path, build_dict=False)
+    results = multiprocessing.Queue()
+    tokens_per_sec = []
+    for world_size in world_sizes:
+        torch.manual_seed(0)
+        encoder = EncoderRNN(word_dict.n_words, hidden, n_layers)
+        decoder = AttnDecoderRNN(attn_model, hidden, word_dict.n_words, n_layers, dropout_p=dropout_p)
+        encoder.share_memory()
+        decoder.share_memory()
+
+        start = now()
+        launch(hogwild_worker, world_size, encoder, decoder, corpus, n_updates // world_size, batch_size, results)
+        losses = sorted(sum([results.get() for _ in range(world_size)], []))
+        tokens_per_sec.append(sum(n for _, _, n in losses) / (now() - start))
+
+        segments = [losses[i * len(losses) // n_segments:(i + 1) * len(losses) // n_segments] for i in range(n_segments)]
+        curve = ' '.join('{:.2f}@{:.0f}s'.format(sum(l for _, l, _ in segment) / len(segment), segment[-1][0] - start)
+                         for segment in segments)
+        print('hogwild[{}]: {:.1f} tokens/sec ({:.2f}x), loss {} (B={}, H={}, {} updates, {} cores)'.format(
+            world_size, tokens_per_sec[-1], tokens_per_sec[-1] / tokens_per_sec[0], curve, batch_size, hidden,
+            len(losses), multiprocessing.cpu_count()))
+    return tokens_per_sec
+
+
+def count_parameters(*modules):
+    return sum(p.data.numel() for module in modules for p in module.parameters())
+
+
+def matched_transformer(n_classes, n_params):
+    # Transformer with transformer.n_layers and n_heads whose d_model, a multiple of n_heads with d_ff = 4 * d_model,
+    # brings its parameter count closest to n_params
+    def build(units):
+        size = units * transformer.n_heads
+        return (transformer.TransformerEncoder(n_classes, size, transformer.n_layers, transformer.n_heads, 4 * size),
+                transformer.TransformerDecoder(n_classes, size, transformer.n_layers, transformer.n_heads, 4 * size))
+
+    low, high = 1, 1024 // transformer.n_heads
+    while low < high:
+        middle = (low + high) // 2
+        if count_parameters(*build(middle)) < n_params:
+            low = middle + 1
+        else:
+            high = middle
+    models = [build(units) for units in set([max(1, low - 1), low])]
+    return min(models, key=lambda model: abs(count_parameters(*model) - n_params))
+
+
+def bench_transformer(batch_size=32, seq_len=30, n_classes=5000, n_steps=3):
+    # Training (teacher-forced encoder and decoder forward and backward) and greedy decoding tokens/sec of the GRU
+    # models and of a Transformer with as many parameters as the input-feeding one
+    inputs = Variable(torch.LongTensor(batch_size, seq_len).random_(3, n_classes))
+    targets = Variable(torch.LongTensor(batch_size, seq_len).random_(3, n_classes))
+    sos = Variable(torch.LongTensor(batch_size, 1).fill_(SOS_token))
+    lengths = [seq_len] * batch_size
+    mask = encoder_mask(lengths, seq_len)
+
+    def encode(encoder, decoder, inputs):
+        encoder_outputs, hidden = encoder(inputs, lengths, encoder.init_hidden(batch_size))
+        return encoder_outputs, hidden, decoder.attn_keys(encoder_outputs)
+
+    def train(encoder, decoder):
+        encoder_outputs, hidden, attn_keys = encode(encoder, decoder, inputs)
+        decoder_inputs = torch.cat((sos, targets[:, :-1]), 1)
+        if decoder.input_feeding:
+            context, features = Variable(torch.zeros(batch_size, decoder.hidden_size)), []
+            for t in range(seq_len):
+                feature, context, hidden, _ = decoder.features(decoder_inputs[:, t:t + 1], context, hidden,
+                                                               encoder_outputs, attn_keys, mask)
+                features.append(feature.unsqueeze(1))
+            features = torch.cat(features, 1)
+        else:
+            features, _, _ = decoder.sequence_features(decoder_inputs, hidden, encoder_outputs, attn_keys, mask)
+        decoder.out(features).sum().backward()
+
+    def decode(encoder, decoder):
+        encoder_outputs, hidden, attn_keys = encode(encoder, decoder, Variable(inputs.data, volatile=True))
+        context = Variable(torch.zeros(batch_size, decoder.hidden_size), volatile=True)
+        decoder_input = Variable(sos.data, volatile=True)
+        for t in range(seq_len):
+            output, context, hidden, _ = decoder(decoder_input, context, hidden, encoder_outputs, attn_keys, mask)
+            decoder_input = Variable(output.data.topk(1)[1], volatile=True)
+
+    gru = (EncoderRNN(n_classes, hidden_size, n_layers),
+           AttnDecoderRNN(attn_model, hidden_size, n_classes, n_layers, dropout_p=dropout_p))
+    luong = LuongDecoderRNN(attn_model, hidden_size, n_classes, n_layers, dropout_p=dropout_p)
+    models = [('gru, input feeding', gru),
+              ('gru, luong', (gru[0], luong)),
+              ('transformer', matched_transformer(n_classes, count_parameters(*gru)))]
+
+    results = []
+    for name, (encoder, decoder) in models:
+        tokens_per_sec = []
+        for fn in (train, decode):
+            # Dropout only while training, so decoding is deterministic and its cached steps match the one-call features
+            encoder.train(fn is train)
+            decoder.train(fn is train)
+            fn(encoder, decoder)  # warm up
+            start = now()
+            for _ in range(n_steps):
+                fn(encoder, decoder)
+            tokens_per_sec.append(n_steps * batch_size * seq_len / (now() - start))
+        results.append(tokens_per_sec)
+        print('transformer[{}]: train {:.1f} tokens/sec, decode {:.1f} tokens/sec, {:.1f}M parameters '
+              '(B={}, T={}, V={}, H={})'.format(name, tokens_per_sec[0], tokens_per_sec[1],
+                                               count_parameters(encoder, decoder) / 1e6, batch_size, seq_len,
+                                               n_classes, decoder.hidden_size))
+    print('transformer speedup over gru with input feeding: train {:.1f}x, decode {:.1f}x'.format(
+        results[2][0] / results[0][0], results[2][1] / results[0][1]))
+    return results
+
+
+benchmarks = {
+    'attn': lambda: [bench_attention(method) for method in ('dot', 'general')],
+    'beam': bench_beam,
+    'decoder': bench_decoder,
+    'encode': bench_encode,
+    'parallel': bench_parallel,
+    'hogwild': bench_hogwild,
+    'transformer': bench_transformer,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(benchmarks.keys())
+    for name in names:
+        benchmarks[name]()
@@ -1,5 +1,15 @@
 class Config:
     use_cuda = True
+    model = 'gru'  # or 'transformer': self-attention encoder and decoder, see seq2seq/transformer.py
+    decoder = 'input_feeding'  # or 'luong': attention after the GRU, teacher-forced targets decoded in one GRU call
     max_seq_length = 100
     train_data_path = './data/train.txt'
-    eval_data_path = './data/eval.txt'
\ No newline at end of file
+    eval_data_path = './data/eval.txt'
+    train_cache_prefix = './data/train'  # compiled by `python preprocess.py`, used instead of train_data_path if present
+    train_shards_path = None  # directory written by `python shard.py write`, read instead of train_data_path if set
+    stream_buffer_size = 0  # > 0 streams train_data_path (a file or a directory of shards) through a shuffle buffer
+    bucket_pool = 50  # batches per length-sorting pool, 0 for plain shuffled batches
+    copy_pair_rate = 1.  # fraction of the pairs with identical source and target trained on each epoch, e.g. 0.2
+    vocab_min_count = 2  # rarer words map to <UNK>
+    vocab_max_size = 50000  # including the special tokens, None for no limit
+    vocab_workers = 4  # processes counting words for the vocabulary, 1 counts in the calling process
@@ -1,17 +1,22 @@
 # -*- coding: utf-8 -*-
 #!/usr/bin/env python
 
+import sys
+
 from model import *
 from preprocess import *
 from config import Config
+from seq2seq.beam import BeamSearch
 
 
-def evaluate(input_variable, len_inputs):
+def evaluate(input_variable, len_inputs, encoder, decoder, shrink=True):
     batch_size, input_length = input_variable.size()
 
     # Run through encoder
     encoder_hidden = encoder.init_hidden(batch_size)
     encoder_outputs, encoder_hidden = encoder(input_variable, len_inputs, encoder_hidden)
+    input_mask = encoder_mask(len_inputs, encoder_outputs.size(1))
+    attn_keys = decoder.attn_keys(encoder_outputs)
 
     # Create starting vectors for decoder
     decoder_input = Variable(torch.LongTensor([[SOS_token] for _ in range(batch_size)]))  # SOS
@@ -24,24 +29,58 @@ def evaluate(input_variable, len_inputs):
     decoded_output = torch.zeros(batch_size, Config.max_seq_length, out=torch.LongTensor(batch_size, Config.max_seq_length))
     decoder_attentions = torch.zeros(batch_size, input_length, input_length)
 
+    # Rows of the batch still being decoded and whether they have emitted EOS
+    active = torch.arange(0, batch_size).long()
+    finished = torch.zeros(batch_size).byte()
+
     # Run through decoder
     for di in range(Config.max_seq_length):
         decoder_output, decoder_context, decoder_hidden, decoder_attention = decoder(decoder_input, decoder_context,
-                                                                                     decoder_hidden, encoder_outputs)
+                                                                                     decoder_hidden, encoder_outputs, attn_keys, input_mask)
         # decoder_attentions[:, di, :decoder_attention.size(2)] += decoder_attention.squeeze(0).squeeze(0).cpu().data
 
-        # Choose top word from output
+        # Choose top word from output, rows that already finished only emit padding
         _, top_index = decoder_output.data.topk(1)
-
-        decoded_output[:, di] = top_index
+        top_index = top_index.cpu().squeeze(1).masked_fill_(finished, PAD_token)
+
+        decoded_output[:, di].index_copy_(0, active, top_index)
+
+        # Stop once every row has emitted EOS
+        finished = finished | (top_index == EOS_token).type_as(finished)
+        if (finished == 0).sum() == 0:
+            break
+
+        # Drop finished rows so they do not keep the decoder busy
+        if shrink and finished.sum() > 0:
+            keep = (finished == 0).nonzero().squeeze(1)
+            active, finished, top_index = [t.index_select(0, keep) for t in (active, finished, top_index)]
+            keep = Variable(keep)
+            if Config.use_cuda: keep = keep.cuda()
+            decoder_context = decoder_context.index_select(0, keep)
+            decoder_hidden = decoder_hidden.index_select(1, keep)
+            encoder_outputs = encoder_outputs.index_select(0, keep)
+            attn_keys = attn_keys.index_select(0, keep)
+            input_mask = input_mask.index_select(0, keep)
 
         # Next input is chosen word
-        decoder_input = Variable(top_index)
+        decoder_input = Variable(top_index.unsqueeze(1))
         if Config.use_cuda: decoder_input = decoder_input.cuda()
 
     return decoded_output  #, decoder_attentions[:, di + 1, :len(encoder_outputs)]
 
 
+def beam_search(input_variable, len_inputs, encoder, searcher):
+    batch_size = input_variable.size(0)
+
+    # Run through encoder, the searcher folds the beams into the batch itself
+    encoder_hidden = encoder.init_hidden(batch_size)
+    encoder_outputs, encoder_hidden = encoder(input_variable, len_inputs, encoder_hidden)
+    input_mask = encoder_mask(len_inputs, encoder_outputs.size(1))
+
+    decoded_output, _ = searcher.decode(encoder_outputs, encoder_hidden, input_mask)
+    return decoded_output
+
+
 def corpus_bleu_single_ref(r, h):
     from nltk.translate.bleu_score import corpus_bleu
     r = np.expand_dims(r, axis=1)
@@ -53,6 +92,11 @@ def corpus_wer(r, h):
     return np.mean(map(lambda (a, b): wer(a, b), zip(r, h)))
 
 
+def strip_padding(batch):
+    # Batches are padded to different widths, so compare sentences without their padding
+    return [[i for i in indexes if i != PAD_token] for indexes in batch]
+
+
 def eval_examples(sources, preds, targets, num=3):
     str = ''
     for i in range(num):
@@ -62,17 +106,31 @@ def eval_examples(sources, preds, targets, num=3):
         str += '#{}\nSource:\t{}\nPred:\t{}\nTarget:\t{}\n\n'.format(i, source, pred, target)
     return str
 
-_, eval_corpus, word_dict = build_corpus()
-encoder, decoder = get_model(word_dict.n_words)
-
-inputs, targets, len_inputs, _ = eval_corpus.next_batch(100)
-input_variable = Variable(torch.LongTensor(inputs), requires_grad=False)
-if Config.use_cuda:
-    input_variable = input_variable.cuda()
+if __name__ == '__main__':
+    # python eval.py [beam_size]: greedy decoding by default, like earlier runs, or beam search of that width
+    beam_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1
 
-output_tensor = evaluate(input_variable, len_inputs)
-preds = output_tensor.cpu().numpy().tolist()
+    # Only the saved vocabulary is needed, not the training corpus
+    word_dict = load_vocab()
+    eval_corpus = Corpus(word_dict, Config.max_seq_length, Config.eval_data_path, build_dict=False)
+    encoder, decoder = get_model(word_dict.n_words)
+    encoder.eval()  # no dropout while decoding
+    decoder.eval()
+    searcher = BeamSearch(decoder, beam_size, Config.max_seq_length, SOS_token, EOS_token, PAD_token)
 
-print('<Baseline>\nWER:{}\nBLEU:{}\n'.format(corpus_wer(targets, inputs), corpus_bleu_single_ref(targets, inputs)))
-print('<Prediction>\nWER:{}\nBLEU:{}\n'.format(corpus_wer(targets, preds), corpus_bleu_single_ref(targets, preds)))
-print('<Examples>\n{}'.format(eval_examples(inputs, preds, targets)))
\ No newline at end of file
+    inputs, targets, len_inputs, _ = eval_corpus.next_batch(100)
+    input_variable = Variable(torch.from_numpy(inputs), requires_grad=False)
+    if Config.use_cuda:
+        input_variable = input_variable.cuda()
+
+    if beam_size > 1:
+        output_tensor = beam_search(input_variable, len_inputs, encoder, searcher)
+        print('<Beam search>\nbeam size:{}\ntokens/sec:{:.1f}\n'.format(beam_size, searcher.tokens_per_sec()))
+    else:
+        output_tensor = evaluate(input_variable, len_inputs, encoder, decoder)
+    preds = strip_padding(output_tensor.cpu().numpy().tolist())
+    inputs, targets = strip_padding(inputs.tolist()), strip_padding(targets.tolist())
+
+    print('<Baseline>\nWER:{}\nBLEU:{}\n'.format(corpus_wer(targets, inputs), corpus_bleu_single_ref(targets, inputs)))
+    print('<Prediction>\nWER:{}\nBLEU:{}\n'.format(corpus_wer(targets, preds), corpus_bleu_single_ref(targets, preds)))
+    print('<Examples>\n{}'.format(eval_examples(inputs, preds, targets)))
\ No newline at end of file
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import sys
+import threading
+from Queue import Queue
+
+import torch
+
+from utils import now
+
+
+class BatchLoader(object):
+    # Prepares the next n_prefetch batches of corpus in a background thread, 0 loads them synchronously
+    def __init__(self, corpus, batch_size=100, max_tokens=None, n_prefetch=4):
+        self.corpus = corpus
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.n_prefetch = n_prefetch
+
+        # Metrics of the last next_batch call: batches ready in the queue before it and seconds spent waiting
+        self.queue_depth = 0
+        self.wait_time = 0.
+        self.padding_ratio = 0.
+        self.copy_ratio = 0.
+
+        # Corpus state right after the last handed out batch; the corpus itself runs ahead by the prefetched ones
+        self.corpus_state = None
+
+        if n_prefetch:
+            self.queue = Queue(maxsize=n_prefetch)
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def load(self):
+        inputs, targets, len_inputs, len_targets = self.corpus.next_batch(self.batch_size, self.max_tokens)
+        return (torch.from_numpy(inputs), torch.from_numpy(targets), len_inputs, len_targets, self.corpus.padding_ratio,
+                self.corpus.copy_ratio, self.corpus.state_dict())
+
+    def run(self):
+        while True:
+            try:
+                self.queue.put((self.load(), None))
+            except Exception:
+                self.queue.put((None, sys.exc_info()))  # raised again with its traceback in next_batch
+                return
+
+    def next_batch(self):
+        # Inputs and targets as LongTensors with their lengths, like Corpus.next_batch
+        start = now()
+        if self.n_prefetch:
+            self.queue_depth = self.queue.qsize()
+            batch, error = self.queue.get()
+            if error:
+                raise error[0], error[1], error[2]
+        else:
+            batch = self.load()
+        self.wait_time = now() - start
+
+        inputs, targets, len_inputs, len_targets, self.padding_ratio, self.copy_ratio, self.corpus_state = batch
+        return inputs, targets, len_inputs, len_targets
@@ -6,22 +6,35 @@ import os
 
 import torch.optim as optim
 
+from preprocess import load_word_dict
+from seq2seq import transformer
 from seq2seq.seq2seq import *
 
 
-def save_state(encoder, decoder, encoder_optim, decoder_optim, step, path='checkpoints/model'):
+def save_state(encoder, decoder, encoder_optim, decoder_optim, step, word_dict=None, corpus_state=None,
+               path='checkpoints/model'):
     state = {'step': step,
              'encoder': encoder.state_dict(),
              'decoder': decoder.state_dict(),
              'encoder_optim': encoder_optim.state_dict(),
-             'decoder_optim': decoder_optim.state_dict()}
+             'decoder_optim': decoder_optim.state_dict(),
+             'corpus': corpus_state}
     filename = path + '-' + str(step)
     torch.save(state, filename)
 
+    # The vocabulary is shared by every checkpoint under path, so inference can load it without the corpus. It is only
+    # written when it changed, see WordDict.save.
+    if word_dict:
+        word_dict.save(path + '.vocab')
+
+
+def load_vocab(path='checkpoints/model'):
+    return load_word_dict(path + '.vocab')
+
 
 def load_state(step=None, path='checkpoints/model'):
     state = {}
-    file_list = glob.glob(path + '*')
+    file_list = glob.glob(path + '-*')
     if file_list:
         if step:
             filename = path + '-' + str(step)
@@ -32,9 +45,18 @@ def load_state(step=None, path='checkpoints/model'):
     return state
 
 
-def get_model(n_classes, state=None, step=None, load=True):
-    encoder = EncoderRNN(n_classes, hidden_size, n_layers)
-    decoder = AttnDecoderRNN(attn_model, hidden_size, n_classes, n_layers, dropout_p=dropout_p)
+def get_model(n_classes=None, state=None, step=None, load=True):
+    if n_classes is None:
+        n_classes = load_vocab().n_words
+    if Config.model == 'transformer':
+        encoder = transformer.TransformerEncoder(n_classes, transformer.d_model, transformer.n_layers,
+                                                 transformer.n_heads, transformer.d_ff, transformer.dropout_p)
+        decoder = transformer.TransformerDecoder(n_classes, transformer.d_model, transformer.n_layers,
+                                                 transformer.n_heads, transformer.d_ff, transformer.dropout_p)
+    else:
+        encoder = EncoderRNN(n_classes, hidden_size, n_layers)
+        decoder_class = LuongDecoderRNN if Config.decoder == 'luong' else AttnDecoderRNN
+        decoder = decoder_class(attn_model, hidden_size, n_classes, n_layers, dropout_p=dropout_p)
     if Config.use_cuda:
         encoder.cuda()
         decoder.cuda()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import multiprocessing
+import os
+import socket
+
+import torch
+import torch.distributed as dist
+
+# Data-parallel training on CPU: world_size processes each train on their own batches, and their gradients are
+# averaged over gloo before every optimizer step, so all of them keep the same weights.
+# MASTER_ADDR and MASTER_PORT in the environment point the processes of several machines to rank 0.
+# Hogwild training only uses launch and share_cores: the processes update models in shared memory without any
+# synchronization.
+
+backend = 'gloo'
+distributed = False  # whether this process joined a process group in init_process
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def launch(fn, world_size, *args):
+    # Run fn(rank, world_size, *args) in world_size local processes and wait for all of them
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ['MASTER_PORT'] = os.environ.get('MASTER_PORT') or str(free_port())
+    processes = [multiprocessing.Process(target=fn, args=(rank, world_size) + args) for rank in range(world_size)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    failed = [rank for rank, p in enumerate(processes) if p.exitcode != 0]
+    assert not failed, 'ranks {} failed'.format(failed)
+
+
+def share_cores(world_size):
+    # Split the cores of the machine between the local processes instead of letting each use all of them
+    torch.set_num_threads(max(1, multiprocessing.cpu_count() // world_size))
+
+
+def init_process(rank, world_size):
+    global distributed
+    share_cores(world_size)
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    distributed = True
+
+
+def is_distributed():
+    # Tracked here rather than asked from torch.distributed, whose is_initialized is missing from PyTorch 0.3
+    return distributed
+
+
+def broadcast_parameters(modules):
+    # Start every rank from the weights of rank 0
+    for module in modules:
+        for p in module.parameters():
+            dist.broadcast(p.data, 0)
+
+
+def all_reduce_gradients(modules):
+    # Average the gradients of all ranks, flattened into one buffer so there is a single all_reduce per step
+    params = [p for module in modules for p in module.parameters() if p.requires_grad]
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.autograd.Variable(p.data.new(p.size()).zero_())
+    grads = [p.grad.data for p in params]
+    flat = torch.cat([g.contiguous().view(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset:offset + g.numel()].view_as(g))
+        offset += g.numel()
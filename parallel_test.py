@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import torch
+import torch.nn as nn
+from torch.autograd import Variable
+
+import parallel
+from parallel import all_reduce_gradients, broadcast_parameters, init_process, is_distributed, launch
+
+
+def make_model(seed):
+    torch.manual_seed(seed)
+    return nn.Linear(4, 3)
+
+
+def gradients(model, seed):
+    # Gradients of the loss on a batch of its own for every rank
+    model.zero_grad()
+    torch.manual_seed(100 + seed)
+    model(Variable(torch.randn(5, 4))).pow(2).sum().backward()
+    return [p.grad.data.clone() for p in model.parameters()]
+
+
+def average_gradients_worker(rank, world_size):
+    assert not is_distributed()
+    init_process(rank, world_size)
+    assert is_distributed()
+
+    # Every rank starts from rank 0's weights, and steps with the gradients averaged over the ranks
+    model = make_model(rank)
+    broadcast_parameters([model])
+    reference = make_model(0)
+    for p, q in zip(model.parameters(), reference.parameters()):
+        assert p.data.equal(q.data)
+
+    expected = [sum(grads) / world_size for grads in zip(*[gradients(reference, r) for r in range(world_size)])]
+    gradients(model, rank)
+    all_reduce_gradients([model])
+    for p, grad in zip(model.parameters(), expected):
+        assert float((p.grad.data - grad).abs().max()) < 1e-6
+
+
+def test_average_gradients():
+    # launch asserts that every rank exits cleanly
+    launch(average_gradients_worker, 2)
+    assert not parallel.distributed
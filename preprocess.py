@@ -1,21 +1,31 @@
 # -*- coding: utf-8 -*-
 #!/usr/bin/env python
 
+import glob
+import json
+import mmap
+import multiprocessing
+import os
 import random
+import shutil
+import zlib
+from collections import Counter
+from itertools import chain, islice, repeat
 import numpy as np
 from config import Config
 
 PAD_token = 0
 SOS_token = 1
 EOS_token = 2
+UNK_token = 3
 
 
 class WordDict:
     def __init__(self):
         self.word2index = {}
         self.word2count = {}
-        self.index2word = {PAD_token: "<PAD>", SOS_token: "<SOS>", EOS_token: "<EOS>"}
-        self.n_words = 3  # Count PAD, SOS and EOS
+        self.index2word = {PAD_token: "<PAD>", SOS_token: "<SOS>", EOS_token: "<EOS>", UNK_token: "<UNK>"}
+        self.n_words = 4  # Count PAD, SOS, EOS and UNK
 
     def add_indexes(self, sentence):
         for word in sentence.split(' '):
@@ -30,46 +40,766 @@ class WordDict:
         else:
             self.word2count[word] += 1
 
-    def sentence_to_indexes(self, sentence, max_length):
-        indexes = [self.word2index[word] for word in sentence.split(' ')][:max_length - 1]
-        indexes.append(EOS_token)
-        n_indexes = len(indexes)
-        indexes.extend([PAD_token for _ in range(max_length - len(indexes))])
-        return indexes, n_indexes
+    def trim(self, min_count=1, max_size=None):
+        # Keep the words seen at least min_count times, at most max_size indexes in total including the special
+        # tokens, and reindex them by frequency and then lexically. Dropped words map to UNK.
+        words = sorted((word for word, count in self.word2count.items() if count >= min_count),
+                       key=lambda word: (-self.word2count[word], word))
+        if max_size:
+            words = words[:max_size - UNK_token - 1]
+
+        self.word2index = {}
+        self.word2count = {word: self.word2count[word] for word in words}
+        self.index2word = {i: self.index2word[i] for i in range(UNK_token + 1)}
+        self.n_words = UNK_token + 1
+        for word in words:
+            self.word2index[word] = self.n_words
+            self.index2word[self.n_words] = word
+            self.n_words += 1
+
+    def save(self, path):
+        # One word and its count per line in index order, the special tokens are implicit.
+        # The same vocabulary is written as arrays for ArrayWordDict, see save_arrays. Files already holding this
+        # vocabulary are left alone, and others are replaced through renames, so processes that have them mapped are
+        # not disturbed.
+        words = [self.index2word[i] for i in range(self.n_words)]
+        if self.is_saved(path, words):
+            return
+        self.save_arrays(path, words)
+        replace_file(path, lambda f: f.writelines('{}\t{}\n'.format(word, self.word2count.get(word, 0))
+                                                  for word in words[UNK_token + 1:]))
+
+    def is_saved(self, path, words):
+        # Whether the files at path hold these words in this order
+        if not (os.path.exists(path) and os.path.islink(path + '.arrays')):
+            return False
+        directory = os.path.realpath(path + '.arrays')
+        offsets = np.load(os.path.join(directory, 'offsets.npy'), mmap_mode='r')
+        with open(os.path.join(directory, 'strings'), 'rb') as f:
+            return f.read() == ''.join(words) and np.array_equal(np.diff(offsets), [len(word) for word in words])
+
+    def save_arrays(self, path, words):
+        # The arrays of one vocabulary go in a directory of their own, named after the crc32 of its words and of its
+        # counts, and the path.arrays link is then switched to it in one rename. A process loading the vocabulary
+        # resolves the link once, so it never maps arrays of two versions together.
+        offsets = np.zeros(self.n_words + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(word) for word in words])
+        counts = np.array([self.word2count.get(word, 0) for word in words], dtype=np.int64)
+
+        # Open addressing with linear probing, at most half full. The special tokens are not looked up.
+        table = np.full(1 << int(2 * self.n_words).bit_length(), -1, dtype=np.int32)
+        mask = len(table) - 1
+        for i in range(UNK_token + 1, self.n_words):
+            slot = zlib.crc32(words[i]) & mask
+            while table[slot] >= 0:
+                slot = (slot + 1) & mask
+            table[slot] = i
+
+        strings = ''.join(words)
+        version = '{}.arrays-{:08x}{:08x}'.format(os.path.basename(path), zlib.crc32(strings) & 0xffffffff,
+                                                  zlib.crc32(counts.tostring()) & 0xffffffff)
+        directory = os.path.join(os.path.dirname(path), version)
+        if not os.path.isdir(directory):
+            temp_directory = '{}.tmp-{}'.format(directory, os.getpid())
+            os.mkdir(temp_directory)
+            with open(os.path.join(temp_directory, 'strings'), 'wb') as f:
+                f.write(strings)
+            np.save(os.path.join(temp_directory, 'offsets.npy'), offsets)
+            np.save(os.path.join(temp_directory, 'counts.npy'), counts)
+            np.save(os.path.join(temp_directory, 'hash.npy'), table)
+            os.rename(temp_directory, directory)
+
+        # Keep the version being replaced, a process may have just resolved the link to it, and remove older ones
+        link = path + '.arrays'
+        previous = os.readlink(link) if os.path.islink(link) else None
+        replace_link(link, version)
+        for old in glob.glob(link + '-*'):
+            if '.tmp-' not in old and os.path.basename(old) not in (version, previous):
+                shutil.rmtree(old)
+
+    def words_to_indexes(self, sentence):
+        return self.lookup(sentence.split(' ')).tolist()
+
+    def lookup(self, words):
+        # Indexes of a list of words as an array, UNK for unknown words
+        return np.fromiter(map(self.word2index.get, words, repeat(UNK_token, len(words))), dtype=np.int64,
+                           count=len(words))
+
+    def sentence_to_indexes(self, sentence, max_length, pad_length=None):
+        return pad_indexes(self.words_to_indexes(sentence), max_length, pad_length)
+
+    def sentences_to_indexes(self, sentences, max_length, pad_length=None):
+        # Batch version of sentence_to_indexes: one (B, pad_length) matrix and the lengths, with the words of all
+        # sentences looked up in one pass
+        words = [sentence.split(' ')[:max_length - 1] for sentence in sentences]
+        lengths = np.array([len(w) for w in words], dtype=np.int64)
+        indexes = self.lookup(list(chain.from_iterable(words)))
+        return pad_batch(indexes, lengths, pad_length or max_length)
 
     def indexes_to_sentence(self, indexes):
         indexes = filter(lambda i: i != PAD_token, indexes)
         indexes = map(lambda i: self.index2word[i], indexes)
         return ' '.join(indexes)
 
+    def indexes_to_sentences(self, batch):
+        # Batch version of indexes_to_sentence over a (B, S) matrix, each distinct index is looked up once
+        batch = np.asarray(batch)
+        distinct, inverse = np.unique(batch, return_inverse=True)
+        words = np.array([self.index2word[i] for i in distinct], dtype=object)[inverse].reshape(batch.shape)
+        return [' '.join(row[keep]) for row, keep in zip(words, batch != PAD_token)]
+
+
+class ArrayWordDict(WordDict):
+    # Read-only WordDict over the arrays directory written by WordDict.save: every word in one string table with its
+    # offsets and counts, and a crc32 hash table from word to index. Nothing is boxed per word, and the files are
+    # memory-mapped so forked workers share one copy through the page cache.
+    def __init__(self, directory):
+        self.path = directory
+        with open(os.path.join(directory, 'strings'), 'rb') as f:
+            self.strings = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = np.load(os.path.join(directory, 'offsets.npy'), mmap_mode='r')
+        self.counts = np.load(os.path.join(directory, 'counts.npy'), mmap_mode='r')
+        self.table = np.load(os.path.join(directory, 'hash.npy'), mmap_mode='r')
+        self.n_words = len(self.offsets) - 1
+
+        # The dict-like views WordDict methods look words up through
+        self.word2index = WordIndex(self)
+        self.word2count = WordCount(self)
+        self.index2word = IndexWord(self)
+
+    def word(self, index):
+        return self.strings[self.offsets[index]:self.offsets[index + 1]]
+
+    def index(self, word):
+        mask = len(self.table) - 1
+        slot = zlib.crc32(word) & mask
+        while True:
+            index = self.table[slot]
+            if index < 0:
+                return None
+            if self.word(index) == word:
+                return int(index)
+            slot = (slot + 1) & mask
+
+    def lookup(self, words):
+        # index() for many words at once: every word is hashed once and the probing is done on arrays,
+        # only the candidate words are compared in Python
+        mask = len(self.table) - 1
+        slots = np.fromiter((zlib.crc32(word) & mask for word in words), dtype=np.int64, count=len(words))
+        indexes = np.full(len(words), UNK_token, dtype=np.int64)
+        pending = np.arange(len(words))
+        while len(pending):
+            found = self.table[slots[pending]].astype(np.int64)
+            pending, found = pending[found >= 0], found[found >= 0]  # an empty slot means an unknown word
+            starts, ends = self.offsets[found].tolist(), self.offsets[found + 1].tolist()
+            match = np.array([self.strings[a:b] == words[i] for i, a, b in zip(pending.tolist(), starts, ends)],
+                             dtype=bool)
+            indexes[pending[match]] = found[match]
+            pending = pending[~match]
+            slots[pending] = (slots[pending] + 1) & mask
+        return indexes
+
+
+class WordIndex(object):
+    def __init__(self, word_dict):
+        self.word_dict = word_dict
+
+    def get(self, word, default=None):
+        index = self.word_dict.index(word)
+        return default if index is None else index
+
+    def __getitem__(self, word):
+        index = self.word_dict.index(word)
+        if index is None:
+            raise KeyError(word)
+        return index
+
+    def __contains__(self, word):
+        return self.word_dict.index(word) is not None
+
+    def __len__(self):
+        return self.word_dict.n_words - UNK_token - 1
+
+
+class WordCount(WordIndex):
+    def get(self, word, default=None):
+        index = self.word_dict.index(word)
+        return default if index is None else int(self.word_dict.counts[index])
+
+    def __getitem__(self, word):
+        return int(self.word_dict.counts[WordIndex.__getitem__(self, word)])
+
+
+class IndexWord(object):
+    def __init__(self, word_dict):
+        self.word_dict = word_dict
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.word_dict.n_words:
+            raise KeyError(index)
+        return self.word_dict.word(index)
+
+    def __len__(self):
+        return self.word_dict.n_words
+
+
+def replace_file(path, write):
+    # Writes path through write(f) on a temporary file that is then renamed over it. Readers that have the old file
+    # open or mapped keep reading it whole, and new readers see the whole new file.
+    temp_path = '{}.tmp-{}'.format(path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        write(f)
+    os.rename(temp_path, path)
+
+
+def replace_link(path, target):
+    # Points the symbolic link path to target, switching it in one rename like replace_file
+    temp_path = '{}.tmp-{}'.format(path, os.getpid())
+    os.symlink(target, temp_path)
+    os.rename(temp_path, path)
+
+
+def pad_indexes(indexes, max_length, pad_length=None):
+    indexes = indexes[:max_length - 1]
+    indexes.append(EOS_token)
+    n_indexes = len(indexes)
+    indexes.extend([PAD_token for _ in range((pad_length or max_length) - len(indexes))])
+    return indexes, n_indexes
+
+
+def pad_batch(indexes, lengths, pad_length):
+    # indexes holds the (truncated) indexes of all sequences one after the other and lengths their counts.
+    # Returns them as rows of a (B, pad_length) matrix followed by EOS and padding, and the lengths including EOS.
+    batch = np.full((len(lengths), pad_length), PAD_token, dtype=np.int64)
+    batch[np.arange(pad_length)[None, :] < lengths[:, None]] = indexes
+    batch[np.arange(len(lengths)), lengths] = EOS_token
+    return batch, lengths + 1
+
+
+def sequences_to_indexes(sequences, max_length, pad_length=None):
+    # Batch version of pad_indexes for sequences that are already indexes
+    sequences = [np.asarray(sequence[:max_length - 1], dtype=np.int64) for sequence in sequences]
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    return pad_batch(np.concatenate(sequences), lengths, pad_length or max_length)
+
+
+def take_tokens(indexes, lengths, max_tokens):
+    # Longest prefix of the index array whose padded source + target tokens fit in max_tokens, at least one pair.
+    # lengths.size() = (n_pairs, 2)
+    tokens = np.arange(1, len(indexes) + 1) * np.maximum.accumulate(lengths[indexes], axis=0).sum(axis=1)
+    over = np.flatnonzero(tokens[1:] > max_tokens)
+    return indexes[:over[0] + 1] if len(over) else indexes
+
+
+class BucketSampler:
+    # Every epoch shuffles all pairs, sorts them by length within pools of pool_size batches and cuts each pool into
+    # batches, so a batch holds sentences of similar length while batches stay shuffled across buckets. pool_size=1
+    # gives plain shuffled batches. The epoch, the position in it and the RNG state can be saved and restored.
+    # With copies (a boolean array over the pairs), each epoch only keeps a random copy_rate of those pairs.
+    # lengths is an (n_pairs, 2) array and batches are index arrays, nothing is kept per pair in Python objects.
+    def __init__(self, lengths, pool_size=50, rng=None, copies=None, copy_rate=1.):
+        self.lengths = lengths
+        self.pool_size = pool_size
+        self.rng = rng or random.Random()
+        self.copy_rate = copy_rate
+        self.rank, self.world_size = 0, 1
+        if copies is None or copy_rate >= 1:
+            self.edited, self.copies = np.arange(len(lengths)), np.zeros(0, dtype=np.int64)
+        else:
+            self.edited, self.copies = np.flatnonzero(~np.asarray(copies)), np.flatnonzero(copies)
+        # Expected tokens per pair of an epoch, with only copy_rate of the copies in it
+        tokens = lengths.sum(axis=1)
+        n_pairs = len(self.edited) + float(copy_rate) * len(self.copies)
+        self.mean_tokens = (tokens[self.edited].sum() + copy_rate * tokens[self.copies].sum()) / n_pairs
+        self.epoch = 0
+        self.position = 0  # batches of this epoch handed out
+        self.epoch_rng_state = None
+        self.batches = []
+        self.batch_limits = None
+
+    def next_indexes(self, batch_size=None, max_tokens=None):
+        if (batch_size, max_tokens) != self.batch_limits:
+            # First call or new limits: (re)make the batches of the current epoch
+            self.batch_limits = (batch_size, max_tokens)
+            self.start_epoch()
+        elif self.position == len(self.batches):
+            self.epoch += 1
+            self.start_epoch()
+        self.position += 1
+        return self.batches[self.position - 1]
+
+    def start_epoch(self):
+        # The RNG state at the start of the epoch is enough to make its batches again
+        self.epoch_rng_state = self.rng.getstate()
+        self.batches = self.make_batches(*self.batch_limits)
+        self.position = 0
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'position': self.position, 'rng_state': self.epoch_rng_state,
+                'batch_limits': self.batch_limits}
+
+    def load_state_dict(self, state):
+        self.epoch, self.batch_limits = state['epoch'], state['batch_limits']
+        self.rng.setstate(state['rng_state'])
+        self.start_epoch()
+        self.position = state['position']
+
+    def make_batches(self, batch_size=None, max_tokens=None):
+        # Shuffles and sorts run in numpy, with a RandomState seeded from self.rng: the state of self.rng at the start
+        # of an epoch still determines its batches
+        rng = np.random.RandomState(self.rng.randrange(2 ** 32))
+        kept = self.copies[rng.random_sample(len(self.copies)) < self.copy_rate]
+        indexes = rng.permutation(np.concatenate((self.edited, kept)))
+        pool_length = self.pool_size * (batch_size or max(1, int(max_tokens / self.mean_tokens)))
+        batches = []
+        for start in range(0, len(indexes), pool_length):
+            # Stable sort by source and then target length, pairs of equal lengths stay shuffled
+            pool = indexes[start:start + pool_length]
+            lengths = self.lengths[pool]
+            pool = pool[np.lexsort((lengths[:, 1], lengths[:, 0]))]
+            while len(pool):
+                batch = pool[:batch_size or len(pool)]
+                if max_tokens:
+                    batch = take_tokens(batch, self.lengths, max_tokens)
+                batches.append(batch)
+                pool = pool[len(batch):]
+        batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        # Every rank makes the same batches and keeps its share, the same number for all ranks
+        batches = batches[:len(batches) - len(batches) % self.world_size]
+        return batches[self.rank::self.world_size]
+
+    def split(self, rank, world_size, seed):
+        # Make this sampler one of world_size data-parallel ones, all of them must use the same seed
+        self.rank, self.world_size = rank, world_size
+        self.rng.seed(seed)
+
+
+def load_word_dict(path):
+    # Map the arrays written next to the text vocabulary when they are there, of the version path.arrays links to
+    if os.path.islink(path + '.arrays'):
+        return ArrayWordDict(os.path.realpath(path + '.arrays'))
+    word_dict = WordDict()
+    for line in open(path).read().split('\n'):
+        if line:
+            word, count = line.split('\t')
+            word_dict.word2index[word] = word_dict.n_words
+            word_dict.word2count[word] = int(count)
+            word_dict.index2word[word_dict.n_words] = word
+            word_dict.n_words += 1
+    return word_dict
+
+
+def filter_raw_string(str):
+    return str.rstrip('\n').translate(None, '<>')
+
+
+def read_lines(f):
+    # Filtered lines of a corpus file, skipping those that are not a source and a target.
+    # Only the newline is stripped: a target can be empty.
+    for line in f:
+        line = filter_raw_string(line)
+        if line.count('\t') == 1:
+            yield line
+
 
 class Corpus:
-    def __init__(self, dict, max_length, path):
+    # Pairs are kept encoded: the indexes of all sources and of all targets in two flat arrays, and the offsets of
+    # every pair into them, (n_pairs + 1, 2) for source and target. Batches are sliced out of these arrays.
+    def __init__(self, dict, max_length, path, bucket_pool=None, build_dict=True, copy_rate=1.):
         self.max_length = max_length
-        self.lines = self.filter_raw_string(open(path).read()).split('\n')
-        self.pairs = [[s for s in l.split('\t')] for l in self.lines]
         self.dict = dict
-        for pair in self.pairs:
-            self.dict.add_indexes(pair[0])
-            self.dict.add_indexes(pair[1])
-
-    def filter_raw_string(self, str):
-        return str.strip().translate(None, '<>')
-
-    def next_batch(self, batch_size=100):
-        pairs = np.array(random.sample(self.pairs, batch_size))
-        input_lens = [self.dict.sentence_to_indexes(s, self.max_length) for s in pairs[:, 0]]
-        target_lens = [self.dict.sentence_to_indexes(s, self.max_length) for s in pairs[:, 1]]
-        input_lens, target_lens = zip(*sorted(zip(input_lens, target_lens), key=lambda p: p[0][1], reverse=True))
-        inputs = map(lambda i: i[0], input_lens)
-        len_inputs = map(lambda i: i[1], input_lens)
-        targets = map(lambda i: i[0], target_lens)
-        len_targets = map(lambda i: i[1], target_lens)
+        self.path = path
+        with open(path) as f:
+            self.encode_lines(read_lines(f), build_dict)
+        self.sampler = BucketSampler(self.lengths, bucket_pool or 1, copies=self.copies, copy_rate=copy_rate)
+        self.padding_ratio = 0.
+        self.copy_ratio = 0.
+
+    def encode_lines(self, lines, build_dict=False, chunk_size=10000):
+        # Encodes the pairs chunk by chunk, so the text is never held in memory all at once
+        sources, targets, lengths = [], [], []
+        for chunk in iter(lambda: list(islice(lines, chunk_size)), []):
+            pairs = [line.split('\t') for line in chunk]
+            for side, indexes in ((0, sources), (1, targets)):
+                words = [pair[side].split(' ') for pair in pairs]
+                if build_dict:
+                    for word in chain.from_iterable(words):
+                        self.dict.add_index(word)
+                indexes.append(self.dict.lookup(list(chain.from_iterable(words))).astype(np.int32))
+            lengths.extend((len(pair[0].split(' ')), len(pair[1].split(' '))) for pair in pairs)
+
+        self.sources = np.concatenate(sources) if sources else np.zeros(0, dtype=np.int32)
+        self.targets = np.concatenate(targets) if targets else np.zeros(0, dtype=np.int32)
+        self.offsets = np.zeros((len(lengths) + 1, 2), dtype=np.int64)
+        self.offsets[1:] = np.cumsum(np.array(lengths, dtype=np.int64).reshape(-1, 2), axis=0)
+        self.index_pairs()
+
+    def index_pairs(self):
+        # Lengths in indexes (including EOS) of each pair, used to pad batches only as far as needed
+        self.lengths = (np.minimum(np.diff(self.offsets, axis=0), self.max_length - 1) + 1).astype(np.int32)
+        self.copies = copy_pairs(self.sources, self.targets, self.offsets)
+
+    def encode_batch(self, indexes, pad_input, pad_target):
+        starts, ends = self.offsets[indexes], self.offsets[np.asarray(indexes) + 1]
+        inputs, len_inputs = sequences_to_indexes([self.sources[a:b] for a, b in zip(starts[:, 0], ends[:, 0])],
+                                                  self.max_length, pad_input)
+        targets, len_targets = sequences_to_indexes([self.targets[a:b] for a, b in zip(starts[:, 1], ends[:, 1])],
+                                                    self.max_length, pad_target)
         return inputs, targets, len_inputs, len_targets
 
+    def next_batch(self, batch_size=100, max_tokens=None):
+        # With max_tokens, batches are bounded by padded source + target tokens instead of (only) by batch_size
+        return self.make_batch(self.sampler.next_indexes(batch_size, max_tokens))
+
+    def state_dict(self):
+        # Where the corpus is in its epochs, saved in checkpoints so a resumed run continues from there
+        return self.sampler.state_dict()
+
+    def load_state_dict(self, state):
+        self.sampler.load_state_dict(state)
+
+    def split(self, rank, world_size, seed=0):
+        # Train on every world_size-th batch of each epoch, for data-parallel rank out of world_size
+        self.sampler.split(rank, world_size, seed)
+
+    def make_batch(self, indexes):
+        # Pad each side only to the longest sentence in the batch
+        pad_input, pad_target = self.lengths[indexes].max(axis=0)
+        inputs, targets, len_inputs, len_targets = self.encode_batch(indexes, pad_input, pad_target)
+
+        # Longest input first, as pack_padded_sequence needs
+        order = np.argsort(-len_inputs, kind='mergesort')
+        inputs, targets, len_inputs, len_targets = inputs[order], targets[order], len_inputs[order], len_targets[order]
+
+        # Fraction of the batch that is padding, and of its pairs that are copies
+        n_padded = len(indexes) * (pad_input + pad_target)
+        self.padding_ratio = 1. - float(len_inputs.sum() + len_targets.sum()) / n_padded
+        self.copy_ratio = float(self.copies[indexes].sum()) / len(indexes)
+        return inputs, targets, len_inputs.tolist(), len_targets.tolist()
+
+
+def copy_pairs(sources, targets, offsets, chunk_size=100000):
+    # Boolean array of the pairs whose source and target indexes are identical. Words that both map to UNK count as
+    # identical, the model could not tell them apart anyway.
+    lengths = np.diff(offsets, axis=0)
+    copies = lengths[:, 0] == lengths[:, 1]
+    for start in range(0, len(copies), chunk_size):
+        # Compare the equal-length pairs of the chunk token by token
+        ids = start + np.flatnonzero(copies[start:start + chunk_size])
+        n_tokens = lengths[ids, 0]
+        pair_ids = np.repeat(ids, n_tokens)
+        positions = np.arange(n_tokens.sum()) - np.repeat(np.cumsum(n_tokens) - n_tokens, n_tokens)
+        differ = sources[offsets[pair_ids, 0] + positions] != targets[offsets[pair_ids, 1] + positions]
+        copies[pair_ids[differ]] = False
+    return copies
+
+
+class CompiledCorpus(Corpus):
+    # Corpus over the arrays written by compile_corpus. The token arrays and the per-pair lengths and copy flags are
+    # memory-mapped, so startup does not read or index any text and training processes on one host share the page
+    # cache.
+    def __init__(self, dict, max_length, prefix, bucket_pool=None, copy_rate=1.):
+        self.max_length = max_length
+        self.dict = dict
+        self.sources = np.load(prefix + '.src.npy', mmap_mode='r')
+        self.targets = np.load(prefix + '.tgt.npy', mmap_mode='r')
+        self.offsets = np.load(prefix + '.offsets.npy', mmap_mode='r')
+        if os.path.exists(lengths_path(prefix, max_length)) and os.path.exists(prefix + '.copies.npy'):
+            self.lengths = np.load(lengths_path(prefix, max_length), mmap_mode='r')
+            self.copies = np.load(prefix + '.copies.npy', mmap_mode='r')
+        else:
+            self.index_pairs()  # compiled for another max_length
+        self.sampler = BucketSampler(self.lengths, bucket_pool or 1, copies=self.copies, copy_rate=copy_rate)
+        self.padding_ratio = 0.
+        self.copy_ratio = 0.
+
+
+def compile_corpus(corpus, prefix):
+    # Writes the arrays of a text corpus and its vocabulary for CompiledCorpus
+    dtype = np.uint16 if corpus.dict.n_words <= np.iinfo(np.uint16).max + 1 else np.uint32
+    np.save(prefix + '.src.npy', corpus.sources.astype(dtype))
+    np.save(prefix + '.tgt.npy', corpus.targets.astype(dtype))
+    np.save(prefix + '.offsets.npy', corpus.offsets)
+    np.save(lengths_path(prefix, corpus.max_length), corpus.lengths)
+    np.save(prefix + '.copies.npy', corpus.copies)
+    corpus.dict.save(prefix + '.vocab')
+
+
+def lengths_path(prefix, max_length):
+    # Pair lengths are clipped to max_length, so they are saved for the max_length they were compiled with
+    return '{}.lengths-{}.npy'.format(prefix, max_length)
+
+
+def corpus_files(path):
+    # A corpus is a single tab-separated file or a directory of them (shards)
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, '*')))
+    return [path]
+
+
+def file_chunks(paths, n_chunks):
+    # (path, start, end) byte ranges of about equal size over all files, count_words aligns them to lines
+    sizes = [os.path.getsize(path) for path in paths]
+    chunk_size = sum(sizes) // n_chunks + 1
+    return [(path, start, min(start + chunk_size, size))
+            for path, size in zip(paths, sizes) for start in range(0, size, chunk_size)]
+
+
+def chunk_lines(path, start, end):
+    # Lines of a file that start within [start, end)
+    with open(path) as f:
+        if start:
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line
+
+
+def count_words(chunk):
+    # Word counts of the lines of a file that start within [start, end), filtered and split into words the same way
+    # Corpus encodes them
+    counts = Counter()
+    for line in read_lines(chunk_lines(*chunk)):
+        for sentence in line.split('\t'):
+            counts.update(sentence.split(' '))
+    return counts
+
+
+def build_word_dict(paths, min_count=1, max_size=None, n_workers=1):
+    # Streaming pass over the corpus files that only keeps the word counts in memory. The files are counted in
+    # chunks by n_workers processes; trim indexes the merged counts by frequency and then lexically, so the
+    # vocabulary does not depend on n_workers.
+    chunks = file_chunks(paths, n_workers * 4)
+    counts = Counter()
+    if n_workers > 1:
+        pool = multiprocessing.Pool(n_workers)
+        for chunk_counts in pool.imap_unordered(count_words, chunks):
+            counts.update(chunk_counts)
+        pool.close()
+        pool.join()
+    else:
+        for chunk in chunks:
+            counts.update(count_words(chunk))
 
-def build_corpus():
     word_dict = WordDict()
-    train_corpus = Corpus(word_dict, Config.max_seq_length, Config.train_data_path)
-    eval_corpus = Corpus(word_dict, Config.max_seq_length, Config.eval_data_path)
-    return train_corpus, eval_corpus, word_dict
\ No newline at end of file
+    word_dict.word2count = dict(counts)
+    word_dict.trim(min_count, max_size)
+    return word_dict
+
+
+class StreamingCorpus(Corpus):
+    # Corpus for files larger than RAM: pairs are read lazily from the files, pass after pass, through a shuffle
+    # buffer of buffer_size encoded pairs. Each pool of pool_size batches is drawn from the buffer and bucketed like
+    # BucketSampler does, so memory stays bounded by the buffer and the pool whatever the corpus size.
+    def __init__(self, dict, max_length, path, buffer_size=100000, bucket_pool=None, copy_rate=1.):
+        self.max_length = max_length
+        self.dict = dict
+        self.paths = corpus_files(path)
+        self.buffer_size = buffer_size
+        self.pool_size = bucket_pool or 1
+        self.copy_rate = copy_rate
+        self.rank, self.world_size = 0, 1
+        self.rng = random.Random()  # shuffles and draws of this corpus only, seeded per rank by split
+        self.stream = self.read_pairs()
+        self.buffer = []
+        self.pairs, self.lengths, self.batches = [], [], []
+        self.n_pairs_read, self.n_tokens_read = 0, 0
+        self.padding_ratio = 0.
+        self.copy_ratio = 0.
+
+    def read_pairs(self):
+        while True:
+            self.rng.shuffle(self.paths)
+            for path in self.paths:
+                with open(path) as f:
+                    for line in islice(read_lines(f), self.rank, None, self.world_size):
+                        pair = line.split('\t')
+                        source, target = self.dict.words_to_indexes(pair[0]), self.dict.words_to_indexes(pair[1])
+                        if source == target and self.rng.random() >= self.copy_rate:
+                            continue  # copy pairs are dropped from the stream like BucketSampler drops them
+                        self.n_pairs_read += 1
+                        self.n_tokens_read += len(source) + len(target) + 2
+                        yield source, target
+
+    def draw(self, n):
+        # Each drawn pair is swapped for the next one from the stream at a random position of the buffer
+        while len(self.buffer) < self.buffer_size:
+            self.buffer.append(next(self.stream))
+        pairs = []
+        for _ in range(n):
+            i = self.rng.randrange(self.buffer_size)
+            pairs.append(self.buffer[i])
+            self.buffer[i] = next(self.stream)
+        return pairs
+
+    def encode_batch(self, indexes, pad_input, pad_target):
+        inputs, len_inputs = sequences_to_indexes([self.pairs[i][0] for i in indexes], self.max_length, pad_input)
+        targets, len_targets = sequences_to_indexes([self.pairs[i][1] for i in indexes], self.max_length, pad_target)
+        return inputs, targets, len_inputs, len_targets
+
+    def next_batch(self, batch_size=100, max_tokens=None):
+        if not self.batches:
+            mean_tokens = float(self.n_tokens_read) / max(1, self.n_pairs_read) or 1.
+            self.pairs = self.draw(self.pool_size * (batch_size or max(1, int(max_tokens / mean_tokens))))
+            self.lengths = np.minimum([(len(s), len(t)) for s, t in self.pairs], self.max_length - 1) + 1
+            self.copies = np.array([s == t for s, t in self.pairs])
+            self.batches = BucketSampler(self.lengths, self.pool_size, self.rng).make_batches(batch_size, max_tokens)
+        return self.make_batch(self.batches.pop())
+
+    def state_dict(self):
+        # A stream and its shuffle buffer cannot be restored exactly, a resumed run starts a new pass
+        return None
+
+    def split(self, rank, world_size, seed=0):
+        # Every rank reads its own lines of each file
+        self.rank, self.world_size = rank, world_size
+        self.rng.seed(seed + rank)
+
+
+class ShardedCorpus(Corpus):
+    # Corpus over the shards listed in <path>/manifest.json, see write_shards. Every epoch all workers shuffle the
+    # shards with the same seed and deal them out by pair count, so each worker reads a disjoint, deterministic slice.
+    def __init__(self, dict, max_length, path, rank=0, world_size=1, seed=0, bucket_pool=None, copy_rate=1.):
+        self.max_length = max_length
+        self.dict = dict
+        self.path = path
+        self.manifest = json.load(open(os.path.join(path, 'manifest.json')))
+        assert len(self.manifest['shards']) >= world_size, 'need at least one shard per worker'
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.pool_size = bucket_pool or 1
+        self.copy_rate = copy_rate
+        self.epoch = 0
+        self.position = 0  # batches of this epoch handed out
+        self.batches = []
+        self.batch_limits = None
+        self.padding_ratio = 0.
+        self.copy_ratio = 0.
+
+    def assign_shards(self, epoch):
+        # Same result in every worker: each shard in seeded order goes to the worker with the fewest pairs so far
+        shards = list(self.manifest['shards'])
+        random.Random(self.seed + epoch).shuffle(shards)
+        counts = [0] * self.world_size
+        assigned = [[] for _ in range(self.world_size)]
+        for shard in shards:
+            rank = counts.index(min(counts))
+            assigned[rank].append(shard)
+            counts[rank] += shard['count']
+        return assigned[self.rank]
+
+    def load_epoch(self, epoch):
+        self.epoch = epoch
+        shards = self.assign_shards(epoch)
+        self.encode_lines(self.shard_lines(shards))
+        self.pair_ids = [i for shard in shards for i in range(shard['offset'], shard['offset'] + shard['count'])]
+
+    def shard_lines(self, shards):
+        # Filtered lines of the shards one after the other, each file is closed once it is read
+        for shard in shards:
+            with open(os.path.join(self.path, shard['path'])) as f:
+                for line in read_lines(f):
+                    yield line
+
+    def start_epoch(self, epoch):
+        self.load_epoch(epoch)
+        rng = random.Random('{}-{}-{}'.format(self.seed, self.epoch, self.rank))
+        sampler = BucketSampler(self.lengths, self.pool_size, rng, self.copies, self.copy_rate)
+        self.batches = sampler.make_batches(*self.batch_limits)
+        self.position = 0
+
+    def next_batch(self, batch_size=100, max_tokens=None):
+        if (batch_size, max_tokens) != self.batch_limits:
+            self.batch_limits = (batch_size, max_tokens)
+            self.start_epoch(self.epoch)
+        elif self.position == len(self.batches):
+            self.start_epoch(self.epoch + 1)
+        self.position += 1
+        return self.make_batch(self.batches[self.position - 1])
+
+    def state_dict(self):
+        # The batches of an epoch follow from the seed, so the epoch and the position in it are enough
+        return {'epoch': self.epoch, 'position': self.position, 'batch_limits': self.batch_limits}
+
+    def load_state_dict(self, state):
+        # Data-parallel runs save the state of rank 0, other ranks may have fewer batches in that epoch
+        self.batch_limits = state['batch_limits']
+        self.start_epoch(state['epoch'])
+        self.position = min(state['position'], len(self.batches))
+
+
+def write_shards(corpus, path, n_shards):
+    # Splits the pairs of a text corpus into n_shards files under path, with a manifest of their pair counts and global
+    # offsets and the vocabulary, for ShardedCorpus
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    n_pairs = len(corpus.lengths)
+    shard_length = -(-n_pairs // n_shards)
+    shards = []
+    with open(corpus.path) as f:
+        lines = read_lines(f)  # the corpus keeps only the indexes, the text is read again
+        for i, start in enumerate(range(0, n_pairs, shard_length)):
+            shard_lines = list(islice(lines, shard_length))
+            shard = {'path': 'shard-{:05d}.txt'.format(i), 'count': len(shard_lines), 'offset': start}
+            with open(os.path.join(path, shard['path']), 'w') as shard_file:
+                shard_file.write('\n'.join(shard_lines) + '\n')
+            shards.append(shard)
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump({'shards': shards, 'count': n_pairs}, f, indent=2)
+    corpus.dict.save(os.path.join(path, 'vocab'))
+
+
+def train_word_dict():
+    # The vocabulary saved with the sharded or compiled training corpus, or else counted from the training text
+    if Config.train_shards_path:
+        return load_word_dict(os.path.join(Config.train_shards_path, 'vocab'))
+    if Config.train_cache_prefix and os.path.exists(Config.train_cache_prefix + '.offsets.npy'):
+        return load_word_dict(Config.train_cache_prefix + '.vocab')
+    return build_word_dict(corpus_files(Config.train_data_path) + [Config.eval_data_path], Config.vocab_min_count,
+                           Config.vocab_max_size, Config.vocab_workers)
+
+
+def build_corpus(rank=0, world_size=1, seed=0, word_dict=None, with_eval=True):
+    # The training corpus of data-parallel rank out of world_size, whose seed must be the same on every rank, and the
+    # eval corpus (None without with_eval) with their vocabulary, see train_word_dict
+    if word_dict is None:
+        word_dict = train_word_dict()
+
+    if Config.train_shards_path:
+        # Read this worker's slice of the sharded training corpus, see write_shards
+        train_corpus = ShardedCorpus(word_dict, Config.max_seq_length, Config.train_shards_path, rank, world_size,
+                                     seed=seed, bucket_pool=Config.bucket_pool, copy_rate=Config.copy_pair_rate)
+    else:
+        if Config.train_cache_prefix and os.path.exists(Config.train_cache_prefix + '.offsets.npy'):
+            # Use the compiled training corpus when there is one, see compile_corpus
+            train_corpus = CompiledCorpus(word_dict, Config.max_seq_length, Config.train_cache_prefix,
+                                          Config.bucket_pool, Config.copy_pair_rate)
+        elif Config.stream_buffer_size:
+            # Stream the training data when it does not fit in memory
+            train_corpus = StreamingCorpus(word_dict, Config.max_seq_length, Config.train_data_path,
+                                           Config.stream_buffer_size, Config.bucket_pool, Config.copy_pair_rate)
+        else:
+            train_corpus = Corpus(word_dict, Config.max_seq_length, Config.train_data_path, Config.bucket_pool,
+                                  build_dict=False, copy_rate=Config.copy_pair_rate)
+        if world_size > 1:
+            train_corpus.split(rank, world_size, seed)
+
+    eval_corpus = None
+    if with_eval:
+        eval_corpus = Corpus(word_dict, Config.max_seq_length, Config.eval_data_path, build_dict=False)
+    return train_corpus, eval_corpus, word_dict
+
+
+if __name__ == '__main__':
+    # One-time compile of the training text into Config.train_cache_prefix.*, used by build_corpus from then on.
+    # The text is read as a plain Corpus, not from shards or through the streaming buffer.
+    Config.train_cache_prefix, prefix = None, Config.train_cache_prefix
+    Config.train_shards_path, Config.stream_buffer_size = None, 0
+    train_corpus, _, word_dict = build_corpus()
+    compile_corpus(train_corpus, prefix)
+    print('Compiled {} pairs and {} words into {}.*'.format(len(train_corpus.lengths), word_dict.n_words, prefix))
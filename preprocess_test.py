@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import glob
+import os
+import random
+
+import numpy as np
+
+from preprocess import *
+
+
+def test_pad_batch():
+    batch, lengths = pad_batch(np.array([5, 6, 7, 8, 9]), np.array([3, 2]), 5)
+    assert batch.tolist() == [[5, 6, 7, EOS_token, PAD_token], [8, 9, EOS_token, PAD_token, PAD_token]]
+    assert lengths.tolist() == [4, 3]
+
+
+def test_take_tokens():
+    lengths = np.array([[2, 2], [3, 3], [5, 5], [9, 9]])
+    # 2 pairs padded to 3 + 3 fit in 12 tokens, a third pair padded to 5 + 5 does not
+    assert take_tokens(np.array([0, 1, 2, 3]), lengths, 12).tolist() == [0, 1]
+    assert take_tokens(np.array([0, 1]), lengths, 100).tolist() == [0, 1]
+    # A single pair is taken even when it is larger than max_tokens
+    assert take_tokens(np.array([3, 0]), lengths, 10).tolist() == [3]
+
+
+def make_lengths(n_pairs=200, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.randint(1, 30, size=(n_pairs, 2)).astype(np.int32)
+
+
+def test_bucket_sampler_covers_every_pair_once():
+    lengths = make_lengths()
+    sampler = BucketSampler(lengths, pool_size=4, rng=random.Random(0))
+    batches = sampler.make_batches(8)
+    assert sorted(np.concatenate(batches).tolist()) == list(range(len(lengths)))
+    for batch in batches:
+        assert (np.diff(lengths[batch, 0]) >= 0).all()  # sorted by source length within its pool
+
+
+def test_make_batch_pads_to_longest(tmpdir):
+    path = str(tmpdir.join('corpus.txt'))
+    with open(path, 'w') as f:
+        f.write('a b c\ta b\nd\td e f g\nh i\th\n')
+    corpus = Corpus(WordDict(), 10, path)
+    inputs, targets, len_inputs, len_targets = corpus.make_batch(np.array([1, 2]))
+    assert inputs.shape == (2, 3) and targets.shape == (2, 5)
+    assert len_inputs == [3, 2] and len_targets == [2, 5]  # longest input first
+
+
+def test_bucket_sampler_max_tokens():
+    lengths = make_lengths()
+    batches = BucketSampler(lengths, pool_size=4, rng=random.Random(0)).make_batches(max_tokens=100)
+    assert sorted(np.concatenate(batches).tolist()) == list(range(len(lengths)))
+    for batch in batches:
+        assert len(batch) == 1 or len(batch) * lengths[batch].max(axis=0).sum() <= 100
+
+
+def test_bucket_sampler_state_round_trip():
+    lengths = make_lengths()
+    sampler = BucketSampler(lengths, pool_size=4, rng=random.Random(0))
+    for _ in range(30):  # 25 batches of 8 per epoch, so into the second epoch
+        sampler.next_indexes(8)
+    assert sampler.epoch == 1
+    state = sampler.state_dict()
+    expected = [sampler.next_indexes(8).tolist() for _ in range(40)]  # and on into the third one
+    assert sampler.epoch == 2
+
+    resumed = BucketSampler(lengths, pool_size=4, rng=random.Random(1))
+    resumed.load_state_dict(state)
+    assert [resumed.next_indexes(8).tolist() for _ in range(40)] == expected
+
+
+def test_word_counts_match_corpus(tmpdir):
+    path = str(tmpdir.join('corpus.txt'))
+    with open(path, 'w') as f:
+        f.write('a b\ta b\n c <d> \tc d\nno tab here\ntoo\tmany\ttabs\nempty target\t\n')
+    corpus_dict = WordDict()
+    Corpus(corpus_dict, 10, path)
+    assert build_word_dict([path]).word2count == corpus_dict.word2count
+    assert build_word_dict([path], n_workers=2).word2count == corpus_dict.word2count
+
+
+def make_word_dict():
+    word_dict = WordDict()
+    for sentence in ['the cat sat', 'the dog sat down', 'a cat', 'the end']:
+        word_dict.add_indexes(sentence)
+    return word_dict
+
+
+def test_array_word_dict_matches_word_dict(tmpdir):
+    word_dict = make_word_dict()
+    path = str(tmpdir.join('vocab'))
+    word_dict.save(path)
+    array_dict = load_word_dict(path)
+    assert isinstance(array_dict, ArrayWordDict)
+
+    words = ['the', 'cat', 'unknown', 'down', '', 'a']
+    assert array_dict.lookup(words).tolist() == word_dict.lookup(words).tolist()
+    assert [array_dict.word2index.get(word) for word in words] == [word_dict.word2index.get(word) for word in words]
+    assert [array_dict.word2count.get(word) for word in words] == [word_dict.word2count.get(word) for word in words]
+    sentences = ['the cat sat down', 'a dog', 'nothing known here']
+    batch, lengths = word_dict.sentences_to_indexes(sentences, 10)
+    array_batch, array_lengths = array_dict.sentences_to_indexes(sentences, 10)
+    assert array_batch.tolist() == batch.tolist() and array_lengths.tolist() == lengths.tolist()
+    assert array_dict.indexes_to_sentences(batch) == word_dict.indexes_to_sentences(batch)
+
+
+def test_save_keeps_unchanged_vocabulary(tmpdir):
+    word_dict = make_word_dict()
+    path = str(tmpdir.join('vocab'))
+    word_dict.save(path)
+    version, inode = os.readlink(path + '.arrays'), os.stat(path).st_ino
+    word_dict.save(path)
+    load_word_dict(path).save(path)
+    assert os.readlink(path + '.arrays') == version and os.stat(path).st_ino == inode
+
+
+def test_save_switches_versions_whole(tmpdir):
+    path = str(tmpdir.join('vocab'))
+    word_dict = make_word_dict()
+    word_dict.save(path)
+    old_dict = load_word_dict(path)
+    for sentence in ['new words', 'more new words']:
+        word_dict.add_indexes(sentence)
+        word_dict.save(path)
+
+    # A process that loaded the first version keeps reading it, new loads get all arrays of the last one
+    assert old_dict.lookup(['cat', 'new']).tolist() == [make_word_dict().word2index['cat'], UNK_token]
+    new_dict = load_word_dict(path)
+    assert new_dict.lookup(['cat', 'new', 'more']).tolist() == word_dict.lookup(['cat', 'new', 'more']).tolist()
+    assert new_dict.word2count['new'] == 2
+    # Only the last version and the one it replaced are kept
+    assert len(glob.glob(path + '.arrays-*')) == 2
+
+
+def test_copy_pairs():
+    # Pairs: identical, same length but different, different lengths, identical empty source and target
+    sources = np.array([4, 5, 6, 4, 5, 7, 8], dtype=np.int32)
+    targets = np.array([4, 5, 6, 4, 9, 7], dtype=np.int32)
+    offsets = np.array([[0, 0], [3, 3], [5, 5], [7, 6], [7, 6]])
+    assert copy_pairs(sources, targets, offsets).tolist() == [True, False, False, True]
+
+
+def test_bucket_sampler_copy_rate():
+    lengths = make_lengths(1000)
+    copies = np.arange(1000) % 2 == 0
+    sampler = BucketSampler(lengths, pool_size=4, rng=random.Random(0), copies=copies, copy_rate=0.2)
+    ids = np.concatenate(sampler.make_batches(10))
+    assert len(set(ids.tolist())) == len(ids)
+    assert 50 < copies[ids].sum() < 150 and (~copies[ids]).sum() == 500
+    # Token batches are sized from the pairs an epoch keeps: all edited ones and a fifth of the copies
+    tokens = lengths.sum(axis=1)
+    assert abs(sampler.mean_tokens - (tokens[~copies].sum() + 0.2 * tokens[copies].sum()) / 600.) < 1e-6
+
+
+def test_bucket_sampler_split():
+    lengths = make_lengths(203)
+    samplers = [BucketSampler(lengths, pool_size=4) for _ in range(2)]
+    for rank, sampler in enumerate(samplers):
+        sampler.split(rank, 2, seed=7)
+    batches = [sampler.make_batches(10) for sampler in samplers]
+    assert len(batches[0]) == len(batches[1])
+    ids = [set(np.concatenate(rank_batches).tolist()) for rank_batches in batches]
+    assert not ids[0] & ids[1]
+    # One of the 21 batches may be left out, so that both ranks get the same number
+    assert len(ids[0] | ids[1]) >= len(lengths) - 10
+
+
+def test_streaming_corpus_split(tmpdir):
+    path = str(tmpdir.join('corpus.txt'))
+    with open(path, 'w') as f:
+        f.writelines('w{} x\tw{} y\n'.format(i, i) for i in range(40))
+    word_dict = build_word_dict([path])
+    corpora = [StreamingCorpus(word_dict, 10, path, buffer_size=5) for _ in range(2)]
+    state = random.getstate()
+    for rank, corpus in enumerate(corpora):
+        corpus.split(rank, 2, seed=3)
+    sources = [set(), set()]
+    for rank, corpus in enumerate(corpora):
+        for _ in range(5):
+            inputs, _, _, _ = corpus.next_batch(4)
+            sources[rank].update(inputs[:, 0].tolist())
+    # Each rank reads its own lines, drawing from its own RNG and not the random module's
+    assert not sources[0] & sources[1] and len(sources[0] | sources[1]) > 20
+    assert random.getstate() == state
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import time
+
+import torch
+import torch.nn.functional as F
+from torch.autograd import Variable
+from config import Config
+
+
+class BeamSearch(object):
+    # Beam search over a decoder with the AttnDecoderRNN step interface, the beams folded into the batch dimension:
+    # row b * K + k of every decoder state holds beam k of sentence b, and beams are reordered with index_select
+    def __init__(self, decoder, beam_size=5, max_length=Config.max_seq_length, sos_token=1, eos_token=2, pad_token=0,
+                 alpha=1.0):
+        self.decoder = decoder
+        self.beam_size = beam_size
+        self.max_length = max_length
+        self.sos_token = sos_token
+        self.eos_token = eos_token
+        self.pad_token = pad_token
+        self.alpha = alpha  # length normalization, hypotheses are ranked by score / length ** alpha
+
+        # Throughput counters over every decode() call
+        self.n_tokens = 0
+        self.elapsed = 0.
+
+    def tokens_per_sec(self):
+        return self.n_tokens / self.elapsed if self.elapsed else 0.
+
+    def arange(self, n):
+        index = torch.arange(0, n).long()
+        if Config.use_cuda: index = index.cuda()
+        return index
+
+    def tile(self, tensor, dim):
+        # Repeat each sentence beam_size times along dim
+        n = tensor.size(dim)
+        index = self.arange(n).unsqueeze(1).expand(n, self.beam_size).contiguous().view(-1)
+        return tensor.index_select(dim, Variable(index))
+
+    def decode(self, encoder_outputs, encoder_hidden, encoder_mask):
+        # encoder_outputs.size() = (B, S, H), encoder_hidden.size() = (L, B, H), encoder_mask.size() = (B, S)
+        # Returns the best hypothesis of each sentence (B, max_length) and its normalized score (B)
+        start = time.time()
+        batch_size = encoder_outputs.size(0)
+        K = self.beam_size
+
+        attn_keys = self.tile(self.decoder.attn_keys(encoder_outputs), 0)
+        encoder_outputs = self.tile(encoder_outputs, 0)
+        encoder_mask = self.tile(encoder_mask, 0)
+        decoder_hidden = self.tile(encoder_hidden, 1)
+        decoder_context = Variable(torch.zeros(batch_size * K, self.decoder.hidden_size))
+        decoder_input = Variable(torch.LongTensor(batch_size * K, 1).fill_(self.sos_token))
+
+        # Beam bookkeeping, all beams start from the same SOS so only the first one is live
+        scores = torch.zeros(batch_size, K)
+        scores[:, 1:] = -float('inf')
+        sequences = torch.LongTensor(batch_size * K, self.max_length).fill_(self.pad_token)
+        lengths = torch.zeros(batch_size * K)
+        finished = torch.zeros(batch_size * K).byte()
+        sentences = self.arange(batch_size)  # original index of each sentence still being searched
+        beam_range = self.arange(K)
+
+        decoded_output = torch.LongTensor(batch_size, self.max_length).fill_(self.pad_token)
+        decoded_scores = torch.zeros(batch_size)
+
+        if Config.use_cuda:
+            decoder_context, decoder_input = decoder_context.cuda(), decoder_input.cuda()
+            scores, sequences, lengths, finished = scores.cuda(), sequences.cuda(), lengths.cuda(), finished.cuda()
+
+        for t in range(self.max_length):
+            n_active = sentences.size(0)
+            decoder_output, decoder_context, decoder_hidden, _ = self.decoder(decoder_input, decoder_context,
+                                                                              decoder_hidden, encoder_outputs, attn_keys,
+                                                                              encoder_mask)
+            log_probs = F.log_softmax(decoder_output, dim=1).data  # (B * K, V)
+            n_classes = log_probs.size(1)
+
+            # Finished beams can only be extended by padding, at no cost
+            if finished.sum() > 0:
+                pad_scores = log_probs[:, self.pad_token].masked_fill(finished, 0.)
+                log_probs.masked_fill_(finished.unsqueeze(1).expand_as(log_probs), -float('inf'))
+                log_probs[:, self.pad_token] = pad_scores
+
+            # Best K continuations of each sentence over its K beams x V words
+            total = (scores.view(-1, 1).expand_as(log_probs) + log_probs).view(n_active, K * n_classes)
+            scores, top = total.topk(K, dim=1)
+            beams = top / n_classes
+            words = (top - beams * n_classes).view(-1)
+            offsets = self.arange(n_active) * K
+            origin = (beams + offsets.unsqueeze(1).expand_as(beams)).view(-1)  # row each new beam extends
+
+            # Reorder the beams and append the chosen words
+            sequences = sequences.index_select(0, origin)
+            sequences[:, t] = words
+            was_finished = finished.index_select(0, origin)
+            lengths = lengths.index_select(0, origin) + (was_finished == 0).float()
+            finished = was_finished | (words == self.eos_token).type_as(was_finished)
+
+            # A sentence stops once all of its beams have finished
+            done = finished.view(n_active, K).min(1)[0]
+            if t == self.max_length - 1:
+                done.fill_(1)
+            if done.sum() > 0:
+                done_index = done.nonzero().squeeze(1)
+                normalized = scores / lengths.view(n_active, K).pow(self.alpha)
+                best_scores, best_beams = normalized.max(1)
+                best_rows = done_index * K + best_beams.index_select(0, done_index)
+                decoded_output.index_copy_(0, sentences.index_select(0, done_index).cpu(),
+                                           sequences.index_select(0, best_rows).cpu())
+                decoded_scores.index_copy_(0, sentences.index_select(0, done_index).cpu(),
+                                           best_scores.index_select(0, done_index).cpu())
+                self.n_tokens += lengths.index_select(0, best_rows).sum()
+
+                keep = (done == 0).nonzero()
+                if keep.numel() == 0:
+                    break
+                keep = keep.squeeze(1)
+                rows = (keep.unsqueeze(1) * K + beam_range.unsqueeze(0).expand(keep.size(0), K)).contiguous().view(-1)
+
+                # Drop finished sentences from every batch-sized state
+                sentences, scores = sentences.index_select(0, keep), scores.index_select(0, keep)
+                sequences, lengths = sequences.index_select(0, rows), lengths.index_select(0, rows)
+                finished, words = finished.index_select(0, rows), words.index_select(0, rows)
+                origin = origin.index_select(0, rows)
+                rows = Variable(rows)
+                encoder_outputs = encoder_outputs.index_select(0, rows)
+                attn_keys = attn_keys.index_select(0, rows)
+                encoder_mask = encoder_mask.index_select(0, rows)
+
+            origin = Variable(origin)
+            decoder_hidden = decoder_hidden.index_select(1, origin)
+            decoder_context = decoder_context.index_select(0, origin)
+            decoder_input = Variable(words.unsqueeze(1))
+
+        self.elapsed += time.time() - start
+        return decoded_output, decoded_scores
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import torch
+from torch.autograd import Variable
+
+from config import Config
+from eval import evaluate
+from preprocess import EOS_token, PAD_token, SOS_token
+from .beam import BeamSearch
+from .seq2seq import AttnDecoderRNN, EncoderRNN, encoder_mask
+
+Config.use_cuda = False
+
+
+def make_model(n_classes=20, hidden_size=8):
+    # Untrained models with sharper outputs and EOS made more likely, so that sentences finish at different steps
+    torch.manual_seed(0)
+    encoder, decoder = EncoderRNN(n_classes, hidden_size, 1), AttnDecoderRNN('general', hidden_size, n_classes, 1)
+    decoder.out.weight.data *= 6
+    decoder.out.bias.data[EOS_token] += 1
+    encoder.eval()
+    decoder.eval()
+    return encoder, decoder
+
+
+def make_inputs(len_inputs, n_classes=20):
+    torch.manual_seed(1)
+    inputs = torch.LongTensor(len(len_inputs), max(len_inputs)).random_(4, n_classes)
+    for row, length in enumerate(len_inputs):
+        inputs[row, length:] = PAD_token
+    return Variable(inputs)
+
+
+def beam_decode(encoder, decoder, inputs, len_inputs, beam_size):
+    searcher = BeamSearch(decoder, beam_size, Config.max_seq_length, SOS_token, EOS_token, PAD_token)
+    encoder_outputs, hidden = encoder(inputs, len_inputs, encoder.init_hidden(inputs.size(0)))
+    return searcher.decode(encoder_outputs, hidden, encoder_mask(len_inputs, inputs.size(1)))
+
+
+def output_lengths(decoded_output):
+    return [row.index(EOS_token) + 1 if EOS_token in row else len(row) for row in decoded_output.tolist()]
+
+
+def test_beam_size_1_is_greedy():
+    encoder, decoder = make_model()
+    len_inputs = [7, 6, 6, 4, 3, 2]
+    inputs = make_inputs(len_inputs)
+    greedy = evaluate(inputs, len_inputs, encoder, decoder)
+    decoded_output, _ = beam_decode(encoder, decoder, inputs, len_inputs, 1)
+    assert len(set(output_lengths(greedy))) > 1
+    assert decoded_output.tolist() == greedy.tolist()
+
+
+def test_finished_sentences_do_not_disturb_the_others():
+    # Sentences are dropped from the search as soon as all their beams have finished. Every sentence must get the
+    # same hypothesis and score as when it is searched alone.
+    encoder, decoder = make_model()
+    len_inputs = [7, 6, 6, 4, 3, 2]
+    inputs = make_inputs(len_inputs)
+    decoded_output, decoded_scores = beam_decode(encoder, decoder, inputs, len_inputs, 3)
+    assert len(set(output_lengths(decoded_output))) > 1
+    for row, length in enumerate(len_inputs):
+        alone, score = beam_decode(encoder, decoder, inputs[row:row + 1, :length], [length], 3)
+        assert alone[0].tolist() == decoded_output[row].tolist()
+        assert abs(score[0] - decoded_scores[row]) < 1e-4
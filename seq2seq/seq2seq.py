@@ -17,6 +17,27 @@ SOS_token = 0
 EOS_token = 1
 
 
+def sequence_mask(sequence_length, max_len=None):
+    if max_len is None:
+        max_len = sequence_length.data.max()
+    batch_size = sequence_length.size(0)
+    seq_range = torch.range(0, max_len - 1).long()
+    seq_range_expand = seq_range.unsqueeze(0).expand(batch_size, max_len)
+    seq_range_expand = Variable(seq_range_expand)
+    if sequence_length.is_cuda:
+        seq_range_expand = seq_range_expand.cuda()
+    seq_length_expand = (sequence_length.unsqueeze(1)
+                         .expand_as(seq_range_expand))
+    return seq_range_expand < seq_length_expand
+
+
+def encoder_mask(len_inputs, max_len):
+    # mask.size() = (B, S), 1 for real encoder positions and 0 for padding
+    len_inputs = Variable(torch.LongTensor(len_inputs))
+    if Config.use_cuda: len_inputs = len_inputs.cuda()
+    return sequence_mask(len_inputs, max_len)
+
+
 class EncoderRNN(nn.Module):
     def __init__(self, input_size, hidden_size, n_layers=1):
         super(EncoderRNN, self).__init__()
@@ -43,6 +64,9 @@ class EncoderRNN(nn.Module):
 
 
 class AttnDecoderRNN(nn.Module):
+    # Input feeding: the attention context of the last step is part of the GRU input, so steps run one at a time
+    input_feeding = True
+
     def __init__(self, attn_model, hidden_size, output_size, n_layers=1, dropout_p=0.1):
         super(AttnDecoderRNN, self).__init__()
 
@@ -62,8 +86,29 @@ class AttnDecoderRNN(nn.Module):
         if attn_model != 'none':
             self.attn = Attn(attn_model, hidden_size)
 
-    def forward(self, input, last_context, last_hidden, encoder_outputs):
+    def attn_keys(self, encoder_outputs):
+        # Compute once after the encoder and pass to every decoder step
+        return self.attn.keys(encoder_outputs)
+
+    def forward(self, input, last_context, last_hidden, encoder_outputs, attn_keys=None, encoder_mask=None):
         # input.size() = (B, 1), last_context.size() = (B, H), last_hidden.size() = (L, B, H), encoder_outputs.size() = (B, S, H)
+        # attn_keys.size() = (B, S, H), encoder_mask.size() = (B, S)
+        features, context, hidden, attn_weights = self.features(input, last_context, last_hidden, encoder_outputs,
+                                                                attn_keys, encoder_mask)
+
+        # Final output layer (next word prediction) using the RNN hidden state and context vector
+        output = self.out(features)  # B x V
+
+        # Return final output, hidden state, and attention weights (for visualization)
+        # output.size() = (B, V)
+        return output, context, hidden, attn_weights
+
+    def features(self, input, last_context, last_hidden, encoder_outputs, attn_keys=None, encoder_mask=None):
+        # Everything in forward but the output layer, so the (B, V) logits can be computed later in chunks
+        # features.size() = (B, 2H)
+        if attn_keys is None:
+            attn_keys = self.attn_keys(encoder_outputs)
+
         # word_embedded.size() = (B, 1, H)
         # print input.size()
         word_embedded = self.embedding(input)
@@ -75,16 +120,40 @@ class AttnDecoderRNN(nn.Module):
         rnn_output = rnn_output.squeeze(1)  # B x S=1 x H -> B x H
 
         # atten_weights.size() = (B, S)
-        attn_weights = self.attn(rnn_output, encoder_outputs)
+        attn_weights = self.attn(rnn_output, attn_keys, encoder_mask)
         context = attn_weights.unsqueeze(1).bmm(encoder_outputs).squeeze(1)  # B x H
 
         # TODO tanh?
-        # Final output layer (next word prediction) using the RNN hidden state and context vector
-        output = self.out(torch.cat((rnn_output, context), -1))  # B x V
+        features = torch.cat((rnn_output, context), -1)  # B x 2H
+        return features, context, hidden, attn_weights
 
-        # Return final output, hidden state, and attention weights (for visualization)
-        # output.size() = (B, V)
-        return output, context, hidden, attn_weights
+
+class LuongDecoderRNN(AttnDecoderRNN):
+    # Attention after the GRU and no input feeding: the GRU only reads the word embeddings, so with teacher forcing it
+    # runs over the whole target in one call and attention is computed for all steps at once, see sequence_features.
+    # Steps keep the AttnDecoderRNN interface; their last_context is not used.
+    input_feeding = False
+
+    def __init__(self, attn_model, hidden_size, output_size, n_layers=1, dropout_p=0.1):
+        super(LuongDecoderRNN, self).__init__(attn_model, hidden_size, output_size, n_layers, dropout_p)
+        self.gru = nn.GRU(hidden_size, hidden_size, n_layers, dropout=dropout_p, batch_first=True)
+
+    def features(self, input, last_context, last_hidden, encoder_outputs, attn_keys=None, encoder_mask=None):
+        # input.size() = (B, 1), features.size() = (B, 2H)
+        features, hidden, attn_weights = self.sequence_features(input, last_hidden, encoder_outputs, attn_keys,
+                                                                encoder_mask)
+        features, attn_weights = features.squeeze(1), attn_weights.squeeze(1)
+        return features, features[:, self.hidden_size:], hidden, attn_weights
+
+    def sequence_features(self, inputs, hidden, encoder_outputs, attn_keys=None, encoder_mask=None):
+        # inputs.size() = (B, T), hidden.size() = (L, B, H), features.size() = (B, T, 2H), attn_weights.size() = (B, T, S)
+        # Padded target positions come after the real ones, so running over them changes no real step
+        if attn_keys is None:
+            attn_keys = self.attn_keys(encoder_outputs)
+        rnn_output, hidden = self.gru(self.embedding(inputs), hidden)
+        attn_weights = self.attn.steps(rnn_output, attn_keys, encoder_mask)
+        context = attn_weights.bmm(encoder_outputs)  # B x T x H
+        return torch.cat((rnn_output, context), -1), hidden, attn_weights
 
 
 class Attn(nn.Module):
@@ -94,6 +163,9 @@ class Attn(nn.Module):
         self.method = method
         self.hidden_size = hidden_size
 
+        if method not in ('dot', 'general'):
+            raise ValueError('unsupported attention method: {}'.format(method))
+
         if self.method == 'general':
             self.attn = nn.Linear(self.hidden_size, hidden_size)
 
@@ -101,41 +173,44 @@ class Attn(nn.Module):
         #     self.attn = nn.Linear(self.hidden_size * 2, hidden_size)
         #     self.other = nn.Parameter(torch.FloatTensor(1, hidden_size))
 
-    def forward(self, hidden, encoder_outputs):
-        # hidden.size() = (B, H), encoder_outputs.size() = (B, S, H)
-        batch_size, encoder_outputs_len, _ = encoder_outputs.size()
+    def forward(self, hidden, attn_keys, encoder_mask=None):
+        # hidden.size() = (B, H), attn_keys.size() = (B, S, H), encoder_mask.size() = (B, S)
 
-        # Create variable to store attention energies
+        # Calculate energies for all encoder outputs at once
         # attn_energies.size() = (B, S)
-        attn_energies = Variable(torch.zeros((batch_size, encoder_outputs_len)))  # B x S
-        if Config.use_cuda: attn_energies = attn_energies.cuda()
+        attn_energies = self.score(hidden, attn_keys)
 
-        # Calculate energies for each encoder output
-        # attn_energies.size() = (B, S)
-        for i in range(encoder_outputs_len):
-            attn_energies[:, i] = self.score(hidden, encoder_outputs[:, i])
-            # print attn_energies[:, i]
+        # Padded encoder positions get zero weight
+        if encoder_mask is not None:
+            attn_energies = attn_energies.masked_fill(encoder_mask == 0, -float('inf'))
 
         # Normalize energies to weights in range 0 to 1
-        return F.softmax(attn_energies)
-
-    def score(self, hidden, encoder_output):
-
-        # print hidden.size(), encoder_output.size()
+        return F.softmax(attn_energies, dim=1)
+
+    def steps(self, hiddens, attn_keys, encoder_mask=None):
+        # forward for T decoder steps at once
+        # hiddens.size() = (B, T, H), attn_keys.size() = (B, S, H), encoder_mask.size() = (B, S), weights (B, T, S)
+        attn_energies = hiddens.bmm(attn_keys.transpose(1, 2))
+        if encoder_mask is not None:
+            attn_energies = attn_energies.masked_fill((encoder_mask == 0).unsqueeze(1).expand_as(attn_energies),
+                                                      -float('inf'))
+        return F.softmax(attn_energies, dim=2)
+
+    def keys(self, encoder_outputs):
+        # Project encoder outputs once per source sentence; they do not change while decoding
+        # encoder_outputs.size() = (B, S, H), keys.size() = (B, S, H)
         if self.method == 'dot':
-            energy = hidden.unsqueeze(1).bmm(encoder_output.unsqueeze(2))  # dot product
-            return energy
+            return encoder_outputs
 
         elif self.method == 'general':
-            energy = self.attn(encoder_output)
-            energy = hidden.unsqueeze(1).bmm(energy.unsqueeze(2))
-            return energy
+            return self.attn(encoder_outputs)
 
-        # TODO
-        # elif self.method == 'concat':
-        #     energy = self.attn(torch.cat((hidden, encoder_output), -1))
-        #     energy = self.other.unsqueeze(1).bmm(energy.unsqueeze(2))
-        #     return energy
+        raise ValueError('unsupported attention method: {}'.format(self.method))
+
+    def score(self, hidden, attn_keys):
+        # hidden.size() = (B, H), attn_keys.size() = (B, S, H), energy.size() = (B, S)
+        energy = attn_keys.bmm(hidden.unsqueeze(2)).squeeze(2)
+        return energy
 
 
 # class BahdanauAttnDecoderRNN(nn.Module):
@@ -1,31 +1,50 @@
 # -*- coding: utf-8 -*-
 #!/usr/bin/env python
 
-from seq2seq import *
-
-encoder_test = EncoderRNN(10, 10, 2)
-decoder_test = AttnDecoderRNN('general', 10, 10, 2)
-print(encoder_test)
-print(decoder_test)
-
-encoder_hidden = encoder_test.init_hidden()
-word_input = Variable(torch.LongTensor([1, 2, 3]))
-if Config.use_cuda:
-    encoder_test.cuda()
-    word_input = word_input.cuda()
-encoder_outputs, encoder_hidden = encoder_test(word_input, encoder_hidden)
-
-word_inputs = Variable(torch.LongTensor([1, 2, 3]))
-decoder_attns = torch.zeros(1, 3, 3)
-decoder_hidden = encoder_hidden
-decoder_context = Variable(torch.zeros(1, decoder_test.hidden_size))
-
-if Config.use_cuda:
-    decoder_test.cuda()
-    word_inputs = word_inputs.cuda()
-    decoder_context = decoder_context.cuda()
-
-for i in range(3):
-    decoder_output, decoder_context, decoder_hidden, decoder_attn = decoder_test(word_inputs[i], decoder_context, decoder_hidden, encoder_outputs)
-    print(decoder_output.size(), decoder_hidden.size(), decoder_attn.size())
-    decoder_attns[0, i] = decoder_attn.squeeze(0).cpu().data
\ No newline at end of file
+import torch
+from torch.autograd import Variable
+
+from config import Config
+from .seq2seq import AttnDecoderRNN, EncoderRNN, LuongDecoderRNN, encoder_mask
+
+Config.use_cuda = False
+
+
+def encode(encoder, len_inputs, seq_len=5, n_classes=10):
+    inputs = Variable(torch.LongTensor(len(len_inputs), seq_len).random_(3, n_classes))
+    return encoder(inputs, len_inputs, encoder.init_hidden(len(len_inputs)))
+
+
+def test_attn_decoder_steps():
+    torch.manual_seed(0)
+    encoder, decoder = EncoderRNN(10, 8, 2), AttnDecoderRNN('general', 8, 10, 2)
+    encoder_outputs, hidden = encode(encoder, [5, 3])
+    mask = encoder_mask([5, 3], 5)
+    context, word = Variable(torch.zeros(2, 8)), Variable(torch.LongTensor([[1], [1]]))
+    for _ in range(3):
+        output, context, hidden, attn_weights = decoder(word, context, hidden, encoder_outputs,
+                                                        decoder.attn_keys(encoder_outputs), mask)
+        assert output.size() == (2, 10) and hidden.size() == (2, 2, 8) and attn_weights.size() == (2, 5)
+        assert float(attn_weights.data[1, 3:].abs().sum()) == 0  # padded source positions
+        word = Variable(output.data.topk(1)[1])
+
+
+def test_luong_sequence_features_match_steps():
+    # Teacher-forced training decodes the whole target in one call, generation one step at a time
+    torch.manual_seed(0)
+    encoder, decoder = EncoderRNN(10, 8, 2), LuongDecoderRNN('general', 8, 10, 2, dropout_p=0.1)
+    decoder.eval()
+    encoder_outputs, hidden = encode(encoder, [5, 4, 2])
+    mask, attn_keys = encoder_mask([5, 4, 2], 5), decoder.attn_keys(encoder_outputs)
+    inputs = Variable(torch.LongTensor(3, 6).random_(3, 10))
+    features, last_hidden, attn_weights = decoder.sequence_features(inputs, hidden, encoder_outputs, attn_keys, mask)
+
+    context, steps, step_weights = Variable(torch.zeros(3, 8)), [], []
+    for t in range(inputs.size(1)):
+        feature, context, hidden, weights = decoder.features(inputs[:, t:t + 1], context, hidden, encoder_outputs,
+                                                             attn_keys, mask)
+        steps.append(feature.unsqueeze(1))
+        step_weights.append(weights.unsqueeze(1))
+    assert float((torch.cat(steps, 1) - features).data.abs().max()) < 1e-5
+    assert float((torch.cat(step_weights, 1) - attn_weights).data.abs().max()) < 1e-5
+    assert float((hidden - last_hidden).data.abs().max()) < 1e-5
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd import Variable
+from config import Config
+from .seq2seq import encoder_mask
+
+# Transformer encoder-decoder with the interface of EncoderRNN and LuongDecoderRNN, so training, greedy decoding and
+# beam search run it unchanged. The decoder "hidden" state is a cache of the self-attention keys and values of the
+# steps decoded so far, (L, B, 1 + t, 2H): position 0 is a placeholder that is never attended to, so the cache has
+# a batch dimension to reorder from the first step on. About the size of the GRU model at a 50000-word vocabulary.
+d_model = 512
+n_heads = 8
+n_layers = 3
+d_ff = 2048
+dropout_p = 0.1
+
+
+def position_encoding(start, length, d_model):
+    # Sinusoids of positions start..start + length - 1, encoding.size() = (T, H)
+    positions = torch.arange(start, start + length).float().unsqueeze(1)
+    rates = torch.exp(torch.arange(0, d_model, 2).float() * (-math.log(10000.) / d_model)).unsqueeze(0)
+    angles = positions.expand(length, rates.size(1)) * rates.expand(length, rates.size(1))
+    encoding = Variable(torch.cat((angles.sin(), angles.cos()), 1))
+    if Config.use_cuda: encoding = encoding.cuda()
+    return encoding
+
+
+def causal_mask(batch_size, start, length):
+    # Steps start..start + T - 1 attend to the start cached steps and to the new steps up to themselves
+    # mask.size() = (B, T, 1 + start + T), key 0 is the cache placeholder and key k + 1 is step k
+    n_keys = 1 + start + length
+    keys = torch.arange(0, n_keys).long().unsqueeze(0).expand(length, n_keys)
+    steps = torch.arange(start + 1, start + length + 1).long().unsqueeze(1).expand(length, n_keys)
+    mask = Variable(((keys <= steps) & (keys >= 1)).unsqueeze(0).expand(batch_size, length, n_keys))
+    if Config.use_cuda: mask = mask.cuda()
+    return mask
+
+
+class LayerNorm(nn.Module):
+    def __init__(self, hidden_size, eps=1e-6):
+        super(LayerNorm, self).__init__()
+        self.gain = nn.Parameter(torch.ones(hidden_size))
+        self.bias = nn.Parameter(torch.zeros(hidden_size))
+        self.eps = eps
+
+    def forward(self, x):
+        mean = x.mean(-1, keepdim=True).expand_as(x)
+        std = x.std(-1, keepdim=True).expand_as(x)
+        return self.gain.expand_as(x) * (x - mean) / (std + self.eps) + self.bias.expand_as(x)
+
+
+class MultiHeadAttn(nn.Module):
+    def __init__(self, hidden_size, n_heads):
+        super(MultiHeadAttn, self).__init__()
+
+        self.hidden_size = hidden_size
+        self.n_heads = n_heads
+
+        self.query = nn.Linear(hidden_size, hidden_size)
+        self.key_value = nn.Linear(hidden_size, hidden_size * 2)
+        self.out = nn.Linear(hidden_size, hidden_size)
+
+    def keys(self, x):
+        # Keys and values of every head side by side, keys.size() = (B, S, 2H) laid out as (heads, key and value)
+        return self.key_value(x)
+
+    def split(self, x):
+        # (B, T, heads * D) -> (B * heads, T, D)
+        batch_size, length, _ = x.size()
+        x = x.contiguous().view(batch_size, length, self.n_heads, -1).transpose(1, 2)
+        return x.contiguous().view(batch_size * self.n_heads, length, -1)
+
+    def forward(self, x, keys, mask=None):
+        # x.size() = (B, T, H), keys.size() = (B, S, 2H), mask.size() = (B, T, S) with 1 where attending is allowed
+        # output.size() = (B, T, H), attn_weights.size() = (B, T, S) averaged over the heads
+        # Keys and values are split into heads in one copy; bmm reads the halves in place
+        batch_size, length, _ = x.size()
+        key, value = self.split(keys).chunk(2, -1)
+        query = self.split(self.query(x)) / math.sqrt(self.hidden_size // self.n_heads)
+
+        attn_energies = query.bmm(key.transpose(1, 2)).view(batch_size, self.n_heads, length, -1)
+        if mask is not None:
+            attn_energies = attn_energies.masked_fill((mask == 0).unsqueeze(1).expand_as(attn_energies), -float('inf'))
+        attn_weights = F.softmax(attn_energies, dim=3)
+
+        context = attn_weights.view(batch_size * self.n_heads, length, -1).bmm(value)
+        context = context.view(batch_size, self.n_heads, length, -1).transpose(1, 2).contiguous()
+        return self.out(context.view(batch_size, length, -1)), attn_weights.mean(1)
+
+
+class FeedForward(nn.Module):
+    def __init__(self, hidden_size, ff_size):
+        super(FeedForward, self).__init__()
+        self.inner = nn.Linear(hidden_size, ff_size)
+        self.outer = nn.Linear(ff_size, hidden_size)
+
+    def forward(self, x):
+        return self.outer(F.relu(self.inner(x)))
+
+
+class EncoderLayer(nn.Module):
+    # Pre-norm: every sublayer reads a normalized copy of x and adds to it
+    def __init__(self, hidden_size, n_heads, ff_size, dropout_p=0.1):
+        super(EncoderLayer, self).__init__()
+        self.self_attn = MultiHeadAttn(hidden_size, n_heads)
+        self.feed_forward = FeedForward(hidden_size, ff_size)
+        self.norms = nn.ModuleList([LayerNorm(hidden_size) for _ in range(2)])
+        self.dropout = nn.Dropout(dropout_p)
+
+    def forward(self, x, mask):
+        h = self.norms[0](x)
+        x = x + self.dropout(self.self_attn(h, self.self_attn.keys(h), mask)[0])
+        return x + self.dropout(self.feed_forward(self.norms[1](x)))
+
+
+class DecoderLayer(nn.Module):
+    def __init__(self, hidden_size, n_heads, ff_size, dropout_p=0.1):
+        super(DecoderLayer, self).__init__()
+        self.self_attn = MultiHeadAttn(hidden_size, n_heads)
+        self.attn = MultiHeadAttn(hidden_size, n_heads)
+        self.feed_forward = FeedForward(hidden_size, ff_size)
+        self.norms = nn.ModuleList([LayerNorm(hidden_size) for _ in range(3)])
+        self.dropout = nn.Dropout(dropout_p)
+
+    def forward(self, x, cache, self_mask, attn_keys, encoder_mask):
+        # x.size() = (B, T, H), cache.size() = (B, 1 + t, 2H), attn_keys.size() = (B, S, 2H)
+        # Returns the new steps, the cache with their keys and values appended and the encoder attention weights
+        h = self.norms[0](x)
+        cache = torch.cat((cache, self.self_attn.keys(h)), 1)
+        x = x + self.dropout(self.self_attn(h, cache, self_mask)[0])
+        context, attn_weights = self.attn(self.norms[1](x), attn_keys, encoder_mask)
+        x = x + self.dropout(context)
+        return x + self.dropout(self.feed_forward(self.norms[2](x))), cache, attn_weights
+
+
+class TransformerEncoder(nn.Module):
+    def __init__(self, input_size, hidden_size, n_layers=1, n_heads=8, ff_size=2048, dropout_p=0.1):
+        super(TransformerEncoder, self).__init__()
+
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        self.n_layers = n_layers
+
+        self.embedding = nn.Embedding(input_size, hidden_size)
+        self.embedding.weight.data.normal_(0, hidden_size ** -0.5)  # unit scale once multiplied by sqrt(H)
+        self.layers = nn.ModuleList([EncoderLayer(hidden_size, n_heads, ff_size, dropout_p) for _ in range(n_layers)])
+        self.norm = LayerNorm(hidden_size)
+        self.dropout = nn.Dropout(dropout_p)
+
+    def init_hidden(self, batch_size):
+        # The decoder state before its first step: a cache holding only the placeholder position, for a decoder with
+        # as many layers as the encoder
+        hidden = Variable(torch.zeros(self.n_layers, batch_size, 1, self.hidden_size * 2))
+        if Config.use_cuda: hidden = hidden.cuda()
+        return hidden
+
+    def forward(self, input_seq, len_inputs, hidden):
+        # input_seq.size() = (B, S), output.size() = (B, S, H); hidden is handed through to the decoder
+        batch_size, seq_len = input_seq.size()
+        mask = encoder_mask(len_inputs, seq_len).unsqueeze(1).expand(batch_size, seq_len, seq_len)
+        embedded = self.embedding(input_seq) * math.sqrt(self.hidden_size)
+        x = self.dropout(embedded + position_encoding(0, seq_len, self.hidden_size).unsqueeze(0).expand_as(embedded))
+        for layer in self.layers:
+            x = layer(x, mask)
+        return self.norm(x), hidden
+
+
+class TransformerDecoder(nn.Module):
+    # Teacher-forced targets go through sequence_features in one call, masked so that no step sees a later one.
+    # Steps keep the AttnDecoderRNN interface and only compute the new position against the cache; their
+    # last_context is not used.
+    input_feeding = False
+
+    def __init__(self, output_size, hidden_size, n_layers=1, n_heads=8, ff_size=2048, dropout_p=0.1):
+        super(TransformerDecoder, self).__init__()
+
+        self.hidden_size = hidden_size
+        self.output_size = output_size
+        self.n_layers = n_layers
+        self.dropout_p = dropout_p
+
+        self.embedding = nn.Embedding(output_size, hidden_size)
+        self.embedding.weight.data.normal_(0, hidden_size ** -0.5)  # unit scale once multiplied by sqrt(H)
+        self.layers = nn.ModuleList([DecoderLayer(hidden_size, n_heads, ff_size, dropout_p) for _ in range(n_layers)])
+        self.norm = LayerNorm(hidden_size)
+        self.dropout = nn.Dropout(dropout_p)
+        self.out = nn.Linear(hidden_size, output_size)
+
+    def attn_keys(self, encoder_outputs):
+        # Encoder keys and values of every layer, computed once after the encoder, attn_keys.size() = (B, S, L * 2H)
+        return torch.cat([layer.attn.keys(encoder_outputs) for layer in self.layers], -1)
+
+    def forward(self, input, last_context, last_hidden, encoder_outputs, attn_keys=None, encoder_mask=None):
+        # input.size() = (B, 1), last_hidden.size() = (L, B, 1 + t, 2H), output.size() = (B, V)
+        features, context, hidden, attn_weights = self.features(input, last_context, last_hidden, encoder_outputs,
+                                                                attn_keys, encoder_mask)
+        return self.out(features), context, hidden, attn_weights
+
+    def features(self, input, last_context, last_hidden, encoder_outputs, attn_keys=None, encoder_mask=None):
+        # input.size() = (B, 1), features.size() = (B, H)
+        features, hidden, attn_weights = self.sequence_features(input, last_hidden, encoder_outputs, attn_keys,
+                                                                encoder_mask)
+        features, attn_weights = features.squeeze(1), attn_weights.squeeze(1)
+        return features, features, hidden, attn_weights
+
+    def sequence_features(self, inputs, hidden, encoder_outputs, attn_keys=None, encoder_mask=None):
+        # inputs.size() = (B, T) following the t steps in hidden.size() = (L, B, 1 + t, 2H)
+        # features.size() = (B, T, H), attn_weights.size() = (B, T, S) from the last layer
+        if attn_keys is None:
+            attn_keys = self.attn_keys(encoder_outputs)
+        batch_size, length = inputs.size()
+        start = hidden.size(2) - 1
+        self_mask = causal_mask(batch_size, start, length)
+        if encoder_mask is not None:
+            encoder_mask = encoder_mask.unsqueeze(1).expand(batch_size, length, encoder_mask.size(1))
+
+        embedded = self.embedding(inputs) * math.sqrt(self.hidden_size)
+        x = self.dropout(embedded + position_encoding(start, length, self.hidden_size).unsqueeze(0).expand_as(embedded))
+        caches = []
+        for i, keys in enumerate(attn_keys.chunk(self.n_layers, -1)):
+            x, cache, attn_weights = self.layers[i](x, hidden[i], self_mask, keys, encoder_mask)
+            caches.append(cache)
+        return self.norm(x), torch.stack(caches), attn_weights
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import torch
+from torch.autograd import Variable
+
+from config import Config
+from .seq2seq import encoder_mask
+from .transformer import TransformerDecoder, TransformerEncoder
+
+Config.use_cuda = False
+
+
+def make_model(n_classes=50, hidden_size=32):
+    torch.manual_seed(0)
+    encoder = TransformerEncoder(n_classes, hidden_size, 2, 4, 64, dropout_p=0.1)
+    decoder = TransformerDecoder(n_classes, hidden_size, 2, 4, 64, dropout_p=0.1)
+    encoder.eval()
+    decoder.eval()
+    return encoder, decoder
+
+
+def encode(encoder, decoder, len_inputs, seq_len=7, n_classes=50):
+    inputs = Variable(torch.LongTensor(len(len_inputs), seq_len).random_(3, n_classes))
+    encoder_outputs, hidden = encoder(inputs, len_inputs, encoder.init_hidden(len(len_inputs)))
+    return inputs, encoder_outputs, hidden, encoder_mask(len_inputs, seq_len), decoder.attn_keys(encoder_outputs)
+
+
+def max_difference(a, b):
+    return float((a - b).data.abs().max())
+
+
+def test_cached_steps_match_one_call():
+    encoder, decoder = make_model()
+    _, encoder_outputs, hidden, mask, attn_keys = encode(encoder, decoder, [7, 5, 3])
+    targets = Variable(torch.LongTensor(3, 6).random_(3, 50))
+    features, cache, _ = decoder.sequence_features(targets, hidden, encoder_outputs, attn_keys, mask)
+
+    context, steps = Variable(torch.zeros(3, decoder.hidden_size)), []
+    for t in range(targets.size(1)):
+        feature, context, hidden, _ = decoder.features(targets[:, t:t + 1], context, hidden, encoder_outputs,
+                                                       attn_keys, mask)
+        steps.append(feature.unsqueeze(1))
+    assert max_difference(torch.cat(steps, 1), features) < 1e-5
+    assert max_difference(hidden, cache) < 1e-5
+
+
+def test_steps_do_not_see_later_targets():
+    encoder, decoder = make_model()
+    _, encoder_outputs, hidden, mask, attn_keys = encode(encoder, decoder, [7, 4])
+    targets = Variable(torch.LongTensor(2, 6).random_(3, 50))
+    changed = targets.clone()
+    changed[:, 4] = (targets[:, 4] + 1) % 50
+    features, _, _ = decoder.sequence_features(targets, hidden, encoder_outputs, attn_keys, mask)
+    changed_features, _, _ = decoder.sequence_features(changed, hidden, encoder_outputs, attn_keys, mask)
+    assert max_difference(features[:, :4], changed_features[:, :4]) == 0
+    assert max_difference(features[:, 4:], changed_features[:, 4:]) > 0
+
+
+def test_source_padding_is_ignored():
+    encoder, decoder = make_model()
+    inputs, encoder_outputs, _, _, _ = encode(encoder, decoder, [7, 3])
+    padded = inputs.clone()
+    padded[1, 3:] = 0
+    padded_outputs, _ = encoder(padded, [7, 3], encoder.init_hidden(2))
+    assert max_difference(encoder_outputs[:, :3], padded_outputs[:, :3]) < 1e-6
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import multiprocessing
+import sys
+
+from preprocess import *
+
+# python shard.py write [n_shards] [path]: split Config.train_data_path into shards for ShardedCorpus
+# python shard.py check [world_size] [path] [n_epochs]: read the shards from world_size local processes, one per
+#                                                       worker, and check every epoch deals out each pair exactly once
+#                                                       and every worker reads as many pairs as the manifest lists
+
+
+def write(n_shards=16, path='./data/shards'):
+    # Shards are cut from the text, so read it as a plain Corpus even when a compiled cache or streaming is set up
+    Config.train_shards_path, Config.train_cache_prefix, Config.stream_buffer_size = None, None, 0
+    train_corpus, _, word_dict = build_corpus(with_eval=False)
+    write_shards(train_corpus, path, n_shards)
+    print('Wrote {} pairs into {} shards under {}'.format(len(train_corpus.lengths), n_shards, path))
+
+
+def read_epochs(args):
+    # Pair ids a worker is dealt in each epoch, and how many pairs it actually read from its shard files
+    path, rank, world_size, n_epochs = args
+    corpus = ShardedCorpus(load_word_dict(os.path.join(path, 'vocab')), Config.max_seq_length, path, rank, world_size)
+    epochs = []
+    for epoch in range(n_epochs):
+        corpus.load_epoch(epoch)
+        epochs.append((corpus.pair_ids, len(corpus.lengths)))
+    return epochs
+
+
+def check(world_size=4, path='./data/shards', n_epochs=2):
+    manifest = json.load(open(os.path.join(path, 'manifest.json')))
+    pool = multiprocessing.Pool(world_size)
+    jobs = [(path, rank, world_size, n_epochs) for rank in range(world_size)]
+    workers = pool.map(read_epochs, jobs)
+    assert workers == pool.map(read_epochs, jobs), 'slices differ between two reads'
+    pool.close()
+
+    for epoch in range(n_epochs):
+        pair_ids = sorted(i for epochs in workers for i in epochs[epoch][0])
+        assert pair_ids == list(range(manifest['count'])), 'epoch {} does not cover every pair once'.format(epoch)
+        for rank, epochs in enumerate(workers):
+            dealt, n_read = len(epochs[epoch][0]), epochs[epoch][1]
+            assert n_read == dealt, 'epoch {}: worker {} read {} pairs from shards listing {}'.format(epoch, rank, n_read,
+                                                                                                     dealt)
+        print('epoch {}: {} pairs per worker'.format(epoch, [epochs[epoch][1] for epochs in workers]))
+    print('OK: {} workers read disjoint slices covering all {} pairs'.format(world_size, manifest['count']))
+
+
+if __name__ == '__main__':
+    command, args = sys.argv[1], sys.argv[2:]
+    if command == 'write':
+        write(*([int(a) for a in args[:1]] + args[1:]))
+    elif command == 'check':
+        check(*([int(a) for a in args[:1]] + args[1:2] + [int(a) for a in args[2:]]))
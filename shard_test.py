@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import os
+
+import pytest
+
+import shard
+from preprocess import *
+
+
+@pytest.fixture
+def text_corpus(tmpdir, monkeypatch):
+    # A training text that also has a compiled cache and a streaming buffer configured
+    train_path, eval_path = str(tmpdir.join('train.txt')), str(tmpdir.join('eval.txt'))
+    with open(train_path, 'w') as f:
+        f.writelines('w{} x\tw{} y\n'.format(i, i % 7) for i in range(40))
+    with open(eval_path, 'w') as f:
+        f.write('a b\ta c\n')
+    monkeypatch.setattr(Config, 'train_data_path', train_path)
+    monkeypatch.setattr(Config, 'eval_data_path', eval_path)
+    monkeypatch.setattr(Config, 'train_shards_path', None)
+    monkeypatch.setattr(Config, 'train_cache_prefix', str(tmpdir.join('train')))
+    monkeypatch.setattr(Config, 'stream_buffer_size', 0)
+    monkeypatch.setattr(Config, 'vocab_min_count', 1)
+    monkeypatch.setattr(Config, 'vocab_workers', 1)
+    compile_corpus(build_corpus(with_eval=False)[0], Config.train_cache_prefix)
+    monkeypatch.setattr(Config, 'stream_buffer_size', 10)
+    return str(tmpdir.join('shards'))
+
+
+def test_write_and_check(text_corpus):
+    shard.write(4, text_corpus)
+    manifest = json.load(open(os.path.join(text_corpus, 'manifest.json')))
+    assert manifest['count'] == 40 and [s['count'] for s in manifest['shards']] == [10] * 4
+    shard.check(2, text_corpus, 2)
+
+
+def test_check_finds_truncated_shard(text_corpus):
+    shard.write(4, text_corpus)
+    path = os.path.join(text_corpus, 'shard-00002.txt')
+    lines = open(path).readlines()
+    with open(path, 'w') as f:
+        f.writelines(lines[:-3])
+    with pytest.raises(AssertionError):
+        shard.check(2, text_corpus, 1)
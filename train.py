@@ -1,40 +1,34 @@
 # -*- coding: utf-8 -*-
 #!/usr/bin/env python
 
+import sys
+
 import torch.optim
 from torch.nn.utils.rnn import pad_packed_sequence as unpack
 
 from model import *
 from preprocess import *
 from utils import *
-from tensorboard_logger import Logger
+from loader import BatchLoader
+from parallel import all_reduce_gradients, broadcast_parameters, init_process, is_distributed, launch, share_cores
 
 final_steps = 50000
+batch_size = 100
+max_batch_tokens = None  # e.g. 6000 to bound batches by padded source + target tokens, set batch_size = None to only use it
+prefetch_batches = 4  # batches prepared ahead in a background thread, 0 to load them synchronously
 print_every = 1
 save_every = 500
 learning_rate = 0.0001
 teacher_forcing_ratio = 0.5
 clip = 5.0
-
-
-def sequence_mask(sequence_length, max_len=None):
-    if max_len is None:
-        max_len = sequence_length.data.max()
-    batch_size = sequence_length.size(0)
-    seq_range = torch.range(0, max_len - 1).long()
-    seq_range_expand = seq_range.unsqueeze(0).expand(batch_size, max_len)
-    seq_range_expand = Variable(seq_range_expand)
-    if sequence_length.is_cuda:
-        seq_range_expand = seq_range_expand.cuda()
-    seq_length_expand = (sequence_length.unsqueeze(1)
-                         .expand_as(seq_range_expand))
-    return seq_range_expand < seq_length_expand
+loss_chunk_size = None  # e.g. 10 to project and backpropagate the loss 10 decoder steps at a time, saving memory
+accumulation_steps = 1  # micro-batches of batch_size whose gradients are summed into one optimizer step
 
 
 # outputs: (B, S, V)
 # targets: (B, S, V)
 # lengths: (B, 1)
-def masked_cross_entropy(logits, targets, lengths):
+def masked_cross_entropy(logits, targets, lengths, n_tokens=None):
     batch_size, seq_len, n_classes = logits.size()
     assert (batch_size, seq_len) == targets.size()
 
@@ -52,111 +46,259 @@ def masked_cross_entropy(logits, targets, lengths):
     losses_flat = -torch.gather(log_probs_flat, dim=1, index=target_flat)
     # losses: (batch, max_len)
     losses = losses_flat.view(*targets.size()) * mask.float()
-    return losses.sum() / lengths.float().sum()
-
-
-def train(input_batch, len_inputs, target_batch, encoder, decoder, encoder_optimizer, decoder_optimizer, criterion):
-    # Zero gradients of both optimizers
+    if n_tokens is None:
+        n_tokens = lengths.float().sum()
+    return losses.sum() / n_tokens
+
+
+# features: (B, S, 2H)
+# targets: (B, S)
+# lengths: (B)
+def chunked_cross_entropy_backward(decoder, features, targets, lengths, chunk_size, n_tokens=None):
+    # Projects decoder features to logits and backpropagates the masked cross-entropy chunk_size steps at a time,
+    # so the (B, S, V) logits and their log_softmax never exist at once
+    if n_tokens is None:
+        n_tokens = lengths.float().sum()
+    detached_features = Variable(features.data, requires_grad=True)
+    total_loss = 0.
+    for start in range(0, features.size(1), chunk_size):
+        logits = decoder.out(detached_features[:, start:start + chunk_size].contiguous())
+        loss = masked_cross_entropy(logits, targets[:, start:start + chunk_size].contiguous(),
+                                    (lengths - start).clamp(min=0), n_tokens)
+        loss.backward()
+        total_loss += loss.data[0]
+
+    # Continue backpropagation from the features through the decoder and the encoder
+    features.backward(detached_features.grad)
+    return total_loss
+
+
+def train(input_batch, len_inputs, target_batch, len_targets, encoder, decoder, encoder_optimizer, decoder_optimizer,
+          criterion):
+    return train_step([(input_batch, len_inputs, target_batch, len_targets)], encoder, decoder, encoder_optimizer,
+                      decoder_optimizer)
+
+
+def train_step(batches, encoder, decoder, encoder_optimizer, decoder_optimizer):
+    # One optimizer step over micro-batches of (input_batch, len_inputs, target_batch, len_targets). The loss is
+    # averaged over the target tokens of all of them, so the step is the same as for one batch holding them all.
     encoder_optimizer.zero_grad()
     decoder_optimizer.zero_grad()
 
+    n_tokens = float(sum(sum(len_targets) for _, _, _, len_targets in batches))
+    loss = 0.
+    for input_batch, len_inputs, target_batch, len_targets in batches:
+        loss += backward(input_batch, len_inputs, target_batch, len_targets, encoder, decoder, n_tokens)
+
+    if is_distributed():
+        all_reduce_gradients([encoder, decoder])
+    torch.nn.utils.clip_grad_norm(encoder.parameters(), clip)
+    torch.nn.utils.clip_grad_norm(decoder.parameters(), clip)
+    encoder_optimizer.step()
+    decoder_optimizer.step()
+
+    # loss is already averaged over the real target tokens
+    return loss
+
+
+def backward(input_batch, len_inputs, target_batch, len_targets, encoder, decoder, n_tokens):
+    # Runs one (micro-)batch and backpropagates its summed token losses divided by n_tokens
+
     # Get size of input and target sentences
-    # batch_size, input_length = input_batch.size()
-    batch_size, target_length = target_batch.size()
+    # Decode only as many steps as the longest real target in the batch
+    batch_size = target_batch.size(0)
+    target_length = max(len_targets)
+    target_batch = target_batch[:, :target_length]
 
-    # TODO parameter를 paddingsequence로 받게끔 하고 아래는 삭제
-    length_targets = Variable(torch.LongTensor(map(lambda s: len(s), target_batch))).cuda()
+    # Real target lengths (including EOS) mask the padding out of the loss
+    length_targets = Variable(torch.LongTensor(len_targets))
+    if Config.use_cuda: length_targets = length_targets.cuda()
 
     # Run words through encoder
     encoder_hidden = encoder.init_hidden(batch_size)
     encoder_outputs, encoder_hidden = encoder(input_batch, len_inputs, encoder_hidden)
+    input_mask = encoder_mask(len_inputs, encoder_outputs.size(1))
+    attn_keys = decoder.attn_keys(encoder_outputs)
 
     # Prepare input and output variables
     decoder_input = Variable(torch.LongTensor([[SOS_token] for _ in range(batch_size)]))
     decoder_context = Variable(torch.zeros(batch_size, decoder.hidden_size))
     decoder_hidden = encoder_hidden  # Use last hidden state from encoder to start decoder
-    decoder_outputs = Variable(torch.FloatTensor(batch_size, target_length, decoder.output_size).zero_())
+    if loss_chunk_size:
+        decoder_features = []
+    else:
+        decoder_outputs = Variable(torch.FloatTensor(batch_size, target_length, decoder.output_size).zero_())
+        if Config.use_cuda: decoder_outputs = decoder_outputs.cuda()
 
     if Config.use_cuda:
         decoder_input = decoder_input.cuda()
         decoder_context = decoder_context.cuda()
-        decoder_outputs = decoder_outputs.cuda()
 
     # Choose whether to use teacher forcing
-    if random.random() < teacher_forcing_ratio:
+    teacher_forcing = random.random() < teacher_forcing_ratio
+    if teacher_forcing and not decoder.input_feeding:
+        # Teacher forcing without input feeding: the whole target, SOS followed by the targets shifted right, goes
+        # through the decoder in one call
+        decoder_inputs = torch.cat((decoder_input, target_batch[:, :-1]), 1)
+        features, _, _ = decoder.sequence_features(decoder_inputs, decoder_hidden, encoder_outputs, attn_keys,
+                                                   input_mask)
+        if loss_chunk_size:
+            decoder_features.append(features)
+        else:
+            decoder_outputs = decoder.out(features)
+    elif teacher_forcing:
         # Teacher forcing: Use the ground-truth target as the next input
         for di in range(target_length):
-            decoder_output, decoder_context, decoder_hidden, decoder_attention = decoder(decoder_input, decoder_context,
-                                                                                         decoder_hidden,
-                                                                                         encoder_outputs)
-            decoder_outputs[:, di] = decoder_output
+            decoder_feature, decoder_context, decoder_hidden, decoder_attention = decoder.features(decoder_input,
+                                                                                                   decoder_context,
+                                                                                                   decoder_hidden,
+                                                                                                   encoder_outputs,
+                                                                                                   attn_keys, input_mask)
+            if loss_chunk_size:
+                decoder_features.append(decoder_feature.unsqueeze(1))
+            else:
+                decoder_outputs[:, di] = decoder.out(decoder_feature)
             decoder_input = target_batch[:, di].unsqueeze(1)  # Next target is next input
     else:
         for di in range(target_length):
-            decoder_output, decoder_context, decoder_hidden, decoder_attention = decoder(decoder_input, decoder_context,
-                                                                                         decoder_hidden,
-                                                                                         encoder_outputs)
-            decoder_outputs[:, di] = decoder_output
+            decoder_feature, decoder_context, decoder_hidden, decoder_attention = decoder.features(decoder_input,
+                                                                                                   decoder_context,
+                                                                                                   decoder_hidden,
+                                                                                                   encoder_outputs,
+                                                                                                   attn_keys, input_mask)
+            if loss_chunk_size:
+                # Logits only to pick the next input, kept out of the graph; the loss projects the features again
+                decoder_features.append(decoder_feature.unsqueeze(1))
+                decoder_output = decoder.out(Variable(decoder_feature.data, volatile=True))
+            else:
+                decoder_output = decoder.out(decoder_feature)
+                decoder_outputs[:, di] = decoder_output
             # Get most likely word index (highest value) from output
             _, top_index = decoder_output.data.topk(1)
             decoder_input = Variable(top_index)  # Chosen word is next input
             if Config.use_cuda: decoder_input = decoder_input.cuda()
 
-            # Stop at end of sentence (not necessary when using known targets)
-            # TODO
-            # if ni == EOS_token: break
-
-    loss = masked_cross_entropy(decoder_outputs, target_batch, length_targets)
+            # No early stop at EOS here: the loop already ends at the longest real target, and every step before
+            # that still has loss-masked target tokens for some row
 
     # Backpropagation
-    loss.backward()
-    torch.nn.utils.clip_grad_norm(encoder.parameters(), clip)
-    torch.nn.utils.clip_grad_norm(decoder.parameters(), clip)
-    encoder_optimizer.step()
-    decoder_optimizer.step()
-
-    return loss.data[0] / target_length
-
-
-# Get train corpus and word_dict
-train_corpus, _, word_dict = build_corpus()
-
-# Build models, optimizers and load states
-state = load_state()
-step = 1
-if state:
-    step = state['step'] + 1
-encoder, decoder = get_model(word_dict.n_words, state=state)
-encoder_optimizer, decoder_optimizer = get_optimizer(encoder, decoder, lr=learning_rate, state=state)
-
-# Define loss function
-criterion = nn.NLLLoss()
-
-# Keep track of time elapsed and running averages
-start = time.time()
-
-# Set configuration for using Tensorboard
-logger = Logger('graphs')
-
-for step in range(step, final_steps + 1):
-
-    # Get training data for this cycle
-    inputs, targets, len_inputs, len_targets = train_corpus.next_batch()
-    input_variable = Variable(torch.LongTensor(inputs), requires_grad=False)
-    target_variable = Variable(torch.LongTensor(targets), requires_grad=False)
-
-    if Config.use_cuda:
-        input_variable = input_variable.cuda()
-        target_variable = target_variable.cuda()
-
-    # Run the train function
-    loss = train(input_variable, len_inputs, target_variable, encoder, decoder, encoder_optimizer, decoder_optimizer, criterion)
-
-    # Keep track of loss
-    logger.scalar_summary('loss', loss, step)
-
-    if step % print_every == 0:
-        print('%s: %s (%d %d%%)' % (step, time_since(start, 1. * step / final_steps), step, step / final_steps * 100))
-
-    if step % save_every == 0:
-        save_state(encoder, decoder, encoder_optimizer, decoder_optimizer, step)
\ No newline at end of file
+    if loss_chunk_size:
+        loss = chunked_cross_entropy_backward(decoder, torch.cat(decoder_features, 1), target_batch, length_targets,
+                                              loss_chunk_size, n_tokens)
+    else:
+        loss = masked_cross_entropy(decoder_outputs, target_batch, length_targets, n_tokens)
+        loss.backward()
+        loss = loss.data[0]
+    return loss
+
+
+def main(rank=0, world_size=1, seed=0, shared=None, word_dict=None):
+    # One training process, rank out of world_size. Data-parallel processes all-reduce their gradients; Hogwild
+    # processes get shared = (word_dict, encoder, decoder) with the models in shared memory, see hogwild.
+    # Several processes get the vocabulary from the parent, which counts it once.
+    if shared:
+        share_cores(world_size)
+    elif world_size > 1:
+        init_process(rank, world_size)
+
+    # Get train corpus and word_dict, every rank trains on its own batches
+    word_dict, encoder, decoder = shared or (word_dict, None, None)
+    train_corpus, _, word_dict = build_corpus(rank, world_size, seed, word_dict, with_eval=False)
+
+    # Build models, optimizers and load states
+    state = load_state()
+    step = 1
+    if state:
+        step = state['step'] + 1
+    if not shared:
+        encoder, decoder = get_model(word_dict.n_words, state=state)
+    encoder_optimizer, decoder_optimizer = get_optimizer(encoder, decoder, lr=learning_rate, state=state)
+    if world_size > 1 and not shared:
+        broadcast_parameters([encoder, decoder])
+
+    # Keep track of time elapsed and running averages
+    start = time.time()
+
+    # Set configuration for using Tensorboard, rank 0 logs and checkpoints for all ranks
+    if rank == 0:
+        from tensorboard_logger import Logger  # imported here, so the training functions import without tensorflow
+        logger = Logger('graphs')
+
+    # Continue the data order where the checkpoint stopped
+    if state and state.get('corpus'):
+        train_corpus.load_state_dict(state['corpus'])
+
+    # Prepare batches ahead of the training step
+    loader = BatchLoader(train_corpus, batch_size, max_batch_tokens, prefetch_batches)
+
+    for step in range(step, final_steps + 1):
+        step_start = time.time()
+        per_step_rss = reset_peak_rss()
+
+        # Get training data for this cycle, accumulation_steps micro-batches, and the loader metrics of each
+        batches, loader_metrics = [], []
+        for _ in range(accumulation_steps):
+            inputs, targets, len_inputs, len_targets = loader.next_batch()
+            loader_metrics.append((loader.padding_ratio, loader.copy_ratio, loader.queue_depth, loader.wait_time))
+            input_variable = Variable(inputs, requires_grad=False)
+            target_variable = Variable(targets, requires_grad=False)
+
+            if Config.use_cuda:
+                input_variable = input_variable.cuda()
+                target_variable = target_variable.cuda()
+            batches.append((input_variable, len_inputs, target_variable, len_targets))
+
+        # Run the train function
+        loss = train_step(batches, encoder, decoder, encoder_optimizer, decoder_optimizer)
+        if rank != 0:
+            continue
+
+        # Keep track of loss, of rank 0's batches only. Throughput counts the tokens of all ranks, assuming their
+        # batches are as large as rank 0's.
+        n_tokens = sum(sum(len_inputs) + sum(len_targets) for _, len_inputs, _, len_targets in batches)
+        tokens_per_sec = world_size * n_tokens / (time.time() - step_start)
+        # Ratios and queue depth are averaged over the micro-batches, the wait is the total of the step
+        padding_ratio, copy_ratio, queue_depth, _ = np.mean(loader_metrics, axis=0)
+        wait_time = sum(metrics[3] for metrics in loader_metrics)
+        logger.scalar_summary('loss', loss, step)
+        logger.scalar_summary('tokens_per_sec', tokens_per_sec, step)
+        logger.scalar_summary('padding_ratio', padding_ratio, step)
+        logger.scalar_summary('copy_ratio', copy_ratio, step)
+        logger.scalar_summary('loader_queue_depth', queue_depth, step)
+        logger.scalar_summary('loader_wait_ms', wait_time * 1000, step)
+        logger.scalar_summary('batch_size', sum(len(batch[1]) for batch in batches), step)
+        # The peak of this step where the kernel can reset it, else the high-water mark of the whole process
+        rss_name = 'step_peak_rss_mb' if per_step_rss else 'process_peak_rss_mb'
+        logger.scalar_summary(rss_name, peak_rss_mb(), step)
+
+        if step % print_every == 0:
+            print('%s: %s (%d %d%%) %d tokens/sec %s peak rss %dMB' % (step, time_since(start, 1. * step / final_steps),
+                                                                       step, step / final_steps * 100, tokens_per_sec,
+                                                                       'step' if per_step_rss else 'process',
+                                                                       peak_rss_mb()))
+
+        if step % save_every == 0:
+            save_state(encoder, decoder, encoder_optimizer, decoder_optimizer, step, word_dict, loader.corpus_state)
+
+
+def hogwild(world_size, seed=0):
+    # Asynchronous training on this machine's CPUs: the models live in shared memory and every process updates them
+    # with its own optimizers as soon as its step is done, without locks, so steps may use slightly stale weights.
+    # Every process runs all steps up to final_steps, one update each.
+    word_dict = train_word_dict()
+    encoder, decoder = get_model(word_dict.n_words)
+    encoder.share_memory()
+    decoder.share_memory()
+    launch(main, world_size, seed, (word_dict, encoder, decoder))
+
+
+if __name__ == '__main__':
+    # python train.py [n_processes] [hogwild]: more than one trains data-parallel on this machine's CPUs, or with
+    # Hogwild updates of shared weights
+    n_processes = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    if sys.argv[2:] == ['hogwild']:
+        hogwild(n_processes, random.randrange(2 ** 31))
+    elif n_processes > 1:
+        launch(main, n_processes, random.randrange(2 ** 31), None, train_word_dict())
+    else:
+        main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import pytest
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.autograd import Variable
+
+import train
+from config import Config
+from seq2seq.seq2seq import AttnDecoderRNN, EncoderRNN, LuongDecoderRNN
+from train import chunked_cross_entropy_backward, masked_cross_entropy, train_step
+from utils import peak_rss_mb, reset_peak_rss
+
+Config.use_cuda = False
+
+
+def test_chunked_loss_matches_full_loss():
+    # Same loss and gradients, for the output layer and for what comes before the features, as projecting all steps
+    # at once. 7 steps in chunks of 3 leave a partial last chunk, and the shorter rows have padded steps.
+    torch.manual_seed(0)
+    decoder, projection = nn.Module(), nn.Linear(4, 6)
+    decoder.out = nn.Linear(6, 11)
+    inputs = Variable(torch.randn(3, 7, 4))
+    targets = Variable(torch.LongTensor(3, 7).random_(0, 11))
+    lengths = Variable(torch.LongTensor([7, 5, 2]))
+
+    loss = masked_cross_entropy(decoder.out(projection(inputs)), targets, lengths)
+    loss.backward()
+    grads = [p.grad.data.clone() for p in list(decoder.parameters()) + list(projection.parameters())]
+
+    decoder.zero_grad()
+    projection.zero_grad()
+    chunked_loss = chunked_cross_entropy_backward(decoder, projection(inputs), targets, lengths, 3)
+    chunked_grads = [p.grad.data for p in list(decoder.parameters()) + list(projection.parameters())]
+    assert abs(chunked_loss - loss.data[0]) < 1e-5
+    for grad, chunked_grad in zip(grads, chunked_grads):
+        assert float((grad - chunked_grad).abs().max()) < 1e-5
+
+
+def test_peak_rss_is_reset():
+    if not reset_peak_rss():
+        return  # the high-water mark can only be reset on Linux
+    before = peak_rss_mb()
+    buffer = bytearray(200 * 1024 * 1024)
+    assert peak_rss_mb() > before + 150
+    del buffer
+    reset_peak_rss()
+    assert peak_rss_mb() < before + 50
+
+
+def make_batch(len_inputs, len_targets, n_classes=12):
+    # Random sentences padded to the longest one of the batch, with their real lengths
+    inputs = torch.LongTensor(len(len_inputs), max(len_inputs)).zero_()
+    targets = torch.LongTensor(len(len_targets), max(len_targets)).zero_()
+    for row, (len_input, len_target) in enumerate(zip(len_inputs, len_targets)):
+        inputs[row, :len_input].random_(3, n_classes)
+        targets[row, :len_target].random_(3, n_classes)
+    return inputs, len_inputs, targets, len_targets
+
+
+def make_model(decoder_class, n_classes=12, hidden_size=8):
+    torch.manual_seed(0)
+    encoder = EncoderRNN(n_classes, hidden_size, 2)
+    decoder = decoder_class('general', hidden_size, n_classes, 2, dropout_p=0.1)
+    encoder.eval()  # no dropout, so both runs compute the same thing
+    decoder.eval()
+    return encoder, decoder, optim.Adam(encoder.parameters()), optim.Adam(decoder.parameters())
+
+
+@pytest.mark.parametrize('decoder_class', [AttnDecoderRNN, LuongDecoderRNN])
+def test_micro_batches_step_like_one_batch(monkeypatch, decoder_class):
+    # The micro-batches together are sorted by input length, like one batch of all their pairs must be
+    monkeypatch.setattr(train, 'teacher_forcing_ratio', 1)
+    torch.manual_seed(1)
+    micro_batches = [make_batch([6, 5], [4, 7]), make_batch([4, 4], [5, 2]), make_batch([3, 2], [3, 6])]
+    one_batch = make_batch([6, 5, 4, 4, 3, 2], [4, 7, 5, 2, 3, 6])
+    for i, (inputs, _, targets, len_targets) in enumerate(micro_batches):
+        one_batch[0][2 * i:2 * i + 2, :inputs.size(1)] = inputs
+        one_batch[2][2 * i:2 * i + 2] = 0
+        one_batch[2][2 * i:2 * i + 2, :targets.size(1)] = targets
+
+    results = []
+    for batches in (micro_batches, [one_batch]):
+        encoder, decoder, encoder_optimizer, decoder_optimizer = make_model(decoder_class)
+        batches = [(Variable(inputs), len_inputs, Variable(targets), len_targets)
+                   for inputs, len_inputs, targets, len_targets in batches]
+        loss = train_step(batches, encoder, decoder, encoder_optimizer, decoder_optimizer)
+        results.append((loss, [p.grad.data for p in list(encoder.parameters()) + list(decoder.parameters())]))
+
+    (loss, grads), (one_loss, one_grads) = results
+    assert abs(loss - one_loss) < 1e-5
+    for grad, one_grad in zip(grads, one_grads):
+        assert float((grad - one_grad).abs().max()) < 1e-5
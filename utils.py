@@ -2,6 +2,7 @@
 #!/usr/bin/env python
 
 import math
+import resource
 import time
 import numpy as np
 
@@ -23,6 +24,30 @@ def now():
     return time.time()
 
 
+def reset_peak_rss():
+    # Restart the resident set size high-water mark of this process, so peak_rss_mb covers what runs from here on.
+    # Linux 4.0+ resets it when 5 is written to clear_refs; returns False where that is not possible.
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss_mb():
+    # High-water mark of the resident set size of this process in MB, since the last reset_peak_rss on Linux.
+    # Elsewhere ru_maxrss, the high-water mark since the process started (in kilobytes on Linux).
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
 # r = reference, h = hypothesis
 def wer(r, h):
     # initialisation